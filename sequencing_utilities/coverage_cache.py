@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Implements the CoverageCache class, which keeps counted coverage on disk so
+that counting the same alignment file again with the same settings is
+served from the cache.
+"""
+import hashlib
+import json
+import os
+from os.path import abspath, expanduser, isfile, join
+
+from .coverage_store import CoverageStore, write_coverage_store
+
+DEFAULT_CACHE_DIR = join("~", ".cache", "sequencing_utilities", "coverage")
+DEFAULT_MAX_BYTES = 10 * 2 ** 30
+
+
+class CoverageCache(object):
+    """
+    Stores counts from count_coverage in a directory of coverage stores.
+
+    Entries are keyed by the path, size and modification time of the
+    alignment file and by the counting settings, so an entry is not used
+    once the file changes. Entries are memory-mapped when they are read,
+    which takes milliseconds even for large genomes.
+
+    When the entries take more than max_bytes, the least recently used
+    ones are removed.
+
+    cache_dir: Directory for the entries. Defaults to the
+    SEQUTILS_CACHE_DIR environment variable, or
+    ~/.cache/sequencing_utilities/coverage.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES):
+        if cache_dir is None:
+            cache_dir = os.environ.get("SEQUTILS_CACHE_DIR",
+                                       DEFAULT_CACHE_DIR)
+        self.cache_dir = expanduser(cache_dir)
+        self.max_bytes = max_bytes
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def key(self, sam_filename, settings):
+        """the cache key for a file counted with a dict of settings"""
+        stat = os.stat(sam_filename)
+        identity = [abspath(sam_filename), stat.st_size, stat.st_mtime,
+                    sorted(settings.items())]
+        return hashlib.sha1(json.dumps(identity).encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return join(self.cache_dir, key + ".cov")
+
+    def get(self, sam_filename, settings):
+        """returns the cached all_counts, or None if they are not cached
+
+        The arrays are read only views of the memory-mapped entry.
+        """
+        path = self._path(self.key(sam_filename, settings))
+        if not isfile(path):
+            return None
+        # the modification time of an entry records when it was last used
+        os.utime(path, None)
+        return CoverageStore(path).all_counts()
+
+    def put(self, sam_filename, settings, all_counts):
+        """store all_counts, then remove old entries if the cache is full"""
+        path = self._path(self.key(sam_filename, settings))
+        temp_path = "%s.%d.tmp" % (path, os.getpid())
+        write_coverage_store(all_counts, temp_path)
+        os.rename(temp_path, path)
+        self.evict()
+
+    def entries(self):
+        """returns a list of (last used, size, path) of all entries"""
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith(".cov"):
+                path = join(self.cache_dir, filename)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        """remove the least recently used entries until the cache fits in
+        max_bytes"""
+        entries = sorted(self.entries())
+        total = sum(size for last_used, size, path in entries)
+        for last_used, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def clear(self):
+        """remove all entries"""
+        for last_used, size, path in self.entries():
+            os.remove(path)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""
+Reads coverage gff files written by makegff in typed chunks, keeping only
+the requested reference and window, so a window of a large or
+multi-replicon genome can be loaded without parsing the whole file into a
+DataFrame.
+
+Files written with makegff --index are bgzip compressed with a tabix
+index, and fetch_coverage reads a region of them by seeking straight to the
+blocks which hold it.
+"""
+from numpy import zeros, array, arange, repeat, cumsum, int64, float32
+
+import pandas
+
+try:
+    import pysam
+except ImportError as e:
+    print(e);
+
+from .coverage_store import parse_region
+
+COLUMNS = ["chromosome", "leftpos", "rightpos", "reads", "strand"]
+
+
+def iter_coverage_gff(gff_file, reference=None, left=None, right=None,
+        chunksize=1000000, reads_dtype=float32):
+    """yield DataFrames of the records of a coverage gff file in chunks
+
+    Every chunk is read with explicit dtypes and filtered to the reference
+    and to the records overlapping left to right (1-based, inclusive)
+    before it is yielded. The columns are chromosome, leftpos, rightpos,
+    reads and strand.
+
+    Once reference has been read and another one starts, the rest of the
+    file is skipped, since makegff writes each reference in one block.
+
+    reads_dtype: The type of the reads column, or None to let pandas infer
+    it.
+    """
+    dtype = {"chromosome": "category", "leftpos": int64, "rightpos": int64,
+             "strand": "category"}
+    if reads_dtype is not None:
+        dtype["reads"] = reads_dtype
+    reader = pandas.read_csv(gff_file, sep="\t", header=None, comment="#",
+        usecols=COLUMNS, names=["chromosome", "source", "name", "leftpos",
+            "rightpos", "reads", "strand", "frame", "attribute"],
+        dtype=dtype, chunksize=chunksize)
+    seen_reference = False
+    for chunk in reader:
+        if len(chunk) == 0:
+            continue
+        last_chromosome = chunk.chromosome.iat[-1]
+        keep = None
+        if reference is not None:
+            keep = chunk.chromosome == reference
+            if keep.any():
+                seen_reference = True
+        if left is not None:
+            in_window = chunk.rightpos >= left
+            keep = in_window if keep is None else keep & in_window
+        if right is not None:
+            in_window = chunk.leftpos <= right
+            keep = in_window if keep is None else keep & in_window
+        if keep is not None:
+            chunk = chunk[keep.values]
+        if len(chunk) > 0:
+            yield chunk[COLUMNS]
+        if seen_reference and last_chromosome != reference:
+            break
+
+
+def read_coverage_gff(gff_file, reference=None, left=None, right=None,
+        chunksize=1000000, dtype=float32):
+    """read a coverage gff file into dense arrays
+
+    Returns {chromosome: {"+": reads, "-": reads}}. If left is given, index
+    i of each array holds base left + i, otherwise index i holds base i.
+    Bases without a record are 0. Arrays end at right if it is given, and
+    otherwise at the last base with a record.
+
+    reference, left and right: Only read this reference, or this window
+    (1-based, inclusive). See iter_coverage_gff.
+
+    dtype: The type of the arrays.
+    """
+    first = 0 if left is None else left
+    records = {}
+    for chunk in iter_coverage_gff(gff_file, reference, left, right,
+                                   chunksize, reads_dtype=dtype):
+        for (chromosome, strand), table in chunk.groupby(
+                ["chromosome", "strand"], observed=True, sort=False):
+            records.setdefault(chromosome, {}).setdefault(strand, []).append(
+                (table.leftpos.values, table.rightpos.values,
+                 table.reads.values))
+    all_counts = {}
+    for chromosome in records:
+        strands = records[chromosome]
+        if right is not None:
+            last = right
+        else:
+            last = max(rightpos.max() for strand in strands
+                       for leftpos, rightpos, reads in strands[strand])
+        all_counts[chromosome] = {}
+        for strand in ["+", "-"]:
+            counts = zeros((max(last - first + 1, 0),), dtype=dtype)
+            for leftpos, rightpos, reads in strands.get(strand, []):
+                _fill_runs(counts, first, last, leftpos, rightpos, reads)
+            all_counts[chromosome][strand] = counts
+    return all_counts
+
+
+def _fill_runs(counts, first, last, leftpos, rightpos, reads):
+    """set counts[i] to the reads of the run covering base first + i, for
+    runs leftpos to rightpos (1-based, inclusive) clipped to first to last"""
+    leftpos = leftpos.clip(first, last) - first
+    rightpos = rightpos.clip(first, last) - first
+    lengths = rightpos - leftpos + 1
+    # expand each run into the indices of its bases
+    offsets = cumsum(lengths) - lengths
+    indices = arange(lengths.sum()) - repeat(offsets, lengths) \
+        + repeat(leftpos, lengths)
+    counts[indices] = repeat(reads, lengths)
+
+
+def fetch_coverage(filename, region):
+    """returns the lines of an indexed coverage file which overlap a
+    "chrom:start-end" region (1-based, inclusive)
+
+    filename: A gff or bedGraph file written by makegff with index=True.
+    Only the compressed blocks holding the region are read.
+    """
+    reference, left, right = parse_region(region)
+    tabix = pysam.TabixFile(filename)
+    try:
+        if reference not in tabix.contigs:
+            return []
+        return list(tabix.fetch(reference,
+                                None if left is None else left - 1, right))
+    finally:
+        tabix.close()
+
+
+def read_coverage_region(filename, region, dtype=float32):
+    """read a region of an indexed coverage file into dense arrays
+
+    Returns {"+": reads, "-": reads}, laid out as in read_coverage_gff: if
+    the region has a start, index i holds base start + i, otherwise index i
+    holds base i. The lines of a bedGraph file have no strand, so values
+    written with a minus sign are taken to be on the "-" strand, as makegff
+    writes them.
+    """
+    reference, left, right = parse_region(region)
+    records = {"+": ([], [], []), "-": ([], [], [])}
+    for line in fetch_coverage(filename, region):
+        fields = line.split("\t")
+        if len(fields) >= 9:
+            start, end, value = int(fields[3]), int(fields[4]), \
+                float(fields[5])
+            strand = fields[6]
+        else:
+            start, end, value = int(fields[1]) + 1, int(fields[2]), \
+                float(fields[3])
+            # a "-" strand value which rounds to 0 is written as -0.00
+            strand = "-" if fields[3].startswith("-") else "+"
+        for column, x in zip(records[strand], (start, end, value)):
+            column.append(x)
+    first = 0 if left is None else left
+    if right is not None:
+        last = right
+    else:
+        last = max([first - 1] + records["+"][1] + records["-"][1])
+    all_counts = {}
+    for strand in ["+", "-"]:
+        counts = zeros((max(last - first + 1, 0),), dtype=dtype)
+        leftpos, rightpos, reads = records[strand]
+        if len(leftpos) > 0:
+            _fill_runs(counts, first, last, array(leftpos, dtype=int64),
+                array(rightpos, dtype=int64), array(reads, dtype=dtype))
+        all_counts[strand] = counts
+    return all_counts
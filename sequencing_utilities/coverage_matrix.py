@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""
+Counts the coverage of many samples into one (samples x strands x
+positions) array, which is backed by a memory-mapped file so a pool of
+processes can fill it in place.
+"""
+import json
+import os
+import tempfile
+from multiprocessing import Pool
+
+from numpy import memmap, dtype as numpy_dtype, uint32
+
+try:
+    import pysam
+except ImportError as e:
+    print(e);
+
+from .makegff import count_coverage, count_coverage_5prime
+
+STRANDS = ["+", "-"]
+
+
+class CoverageMatrix(object):
+    """the counts of several samples, with index i of each reference
+    holding base i (1-based), as in count_coverage
+
+    data: The (samples x strands x positions) array. The references are
+    concatenated along the positions axis, each taking its length + 2.
+
+    samples, references and lengths label the axes, and offsets gives the
+    start of each reference on the positions axis.
+    """
+
+    def __init__(self, data, samples, references, lengths):
+        self.data = data
+        self.samples = list(samples)
+        self.references = list(references)
+        self.lengths = dict(zip(self.references, lengths))
+        self.offsets = {}
+        offset = 0
+        for reference, length in zip(self.references, lengths):
+            self.offsets[reference] = offset
+            offset += length + 2
+
+    @classmethod
+    def open(cls, filename, mode="r"):
+        """open a matrix written by count_coverage_matrix with a filename"""
+        with open(filename + ".json") as infile:
+            header = json.load(infile)
+        data = memmap(filename, dtype=numpy_dtype(header["dtype"]), mode=mode,
+                      shape=tuple(header["shape"]))
+        return cls(data, header["samples"], header["references"],
+                   header["lengths"])
+
+    def fetch(self, reference, left=None, right=None, strand=None):
+        """returns a view of the counts of all samples at bases left to right
+
+        left and right are 1-based and inclusive. The view is (samples x
+        positions) for one strand, or (samples x strands x positions) if
+        strand is None.
+        """
+        if reference not in self.offsets:
+            raise KeyError("reference %s is not in the matrix" % reference)
+        length = self.lengths[reference] + 2
+        left = 0 if left is None else max(left, 0)
+        right = length - 1 if right is None else min(right, length - 1)
+        start = self.offsets[reference]
+        positions = slice(start + left, start + max(right + 1, left))
+        if strand is None:
+            return self.data[:, :, positions]
+        return self.data[:, STRANDS.index(strand), positions]
+
+    def sample(self, sample):
+        """returns {reference: {"+": counts, "-": counts}} of one sample, as
+        views which can be passed to write_coverage"""
+        i = self.samples.index(sample)
+        return dict((reference, dict((strand, self.fetch(reference,
+                    strand=strand)[i]) for strand in STRANDS))
+                    for reference in self.references)
+
+
+def _references(sam_filename):
+    samfile = pysam.Samfile(sam_filename)
+    references = (tuple(samfile.references), tuple(samfile.lengths))
+    samfile.close()
+    return references
+
+
+def _fill_sample(args):
+    """count one sample into its row of the memory-mapped matrix"""
+    sam_filename, filename, shape, count_dtype, row, settings = args
+    samfile = pysam.Samfile(sam_filename)
+    if settings["five_prime"]:
+        all_counts = count_coverage_5prime(samfile, flip=settings["flip"],
+                                           dtype="auto")
+    else:
+        all_counts = count_coverage(samfile, flip=settings["flip"],
+            include_insert=settings["include_insert"], dtype="auto")
+    data = memmap(filename, dtype=count_dtype, mode="r+", shape=shape)
+    offset = 0
+    for reference in samfile.references:
+        counts = all_counts.pop(reference)
+        for i, strand in enumerate(STRANDS):
+            data[row, i, offset:offset + len(counts[strand])] = counts[strand]
+        offset += len(counts["+"])
+    samfile.close()
+    data.flush()
+    del data
+    return row
+
+
+def count_coverage_matrix(sam_filenames, filename=None, samples=None,
+        workers=1, flip=False, include_insert=False, five_prime=False,
+        dtype=uint32):
+    """count the coverage of several samples into one CoverageMatrix
+
+    All files must have the same references. Each file is counted by one of
+    workers processes, which writes its counts straight into the shared
+    matrix, so only one copy of every sample is kept.
+
+    filename: The file backing the matrix, which can be opened again with
+    CoverageMatrix.open. A temporary file is used and removed once mapped
+    if not given; pass a path on /dev/shm to keep it in memory.
+
+    samples: A label for each file. Defaults to the filenames.
+
+    flip, include_insert and five_prime: See write_samfile_to_gff.
+
+    dtype: The type of the counts.
+    """
+    sam_filenames = list(sam_filenames)
+    if samples is None:
+        samples = sam_filenames
+    if len(samples) != len(sam_filenames):
+        raise ValueError("need one sample label for each file")
+    references, lengths = _references(sam_filenames[0])
+    for sam_filename in sam_filenames[1:]:
+        if _references(sam_filename) != (references, lengths):
+            raise ValueError("%s does not have the same references as %s"
+                             % (sam_filename, sam_filenames[0]))
+    count_dtype = numpy_dtype(dtype)
+    shape = (len(sam_filenames), len(STRANDS),
+             sum(length + 2 for length in lengths))
+    temporary = filename is None
+    if temporary:
+        handle, filename = tempfile.mkstemp(suffix=".coverage_matrix")
+        os.close(handle)
+    # allocate the file, which is sparse until it is filled
+    memmap(filename, dtype=count_dtype, mode="w+", shape=shape).flush()
+    settings = {"flip": flip, "include_insert": include_insert,
+                "five_prime": five_prime}
+    tasks = [(sam_filename, filename, shape, count_dtype, row, settings)
+             for row, sam_filename in enumerate(sam_filenames)]
+    try:
+        if workers > 1:
+            pool = Pool(min(workers, len(tasks)))
+            try:
+                for row in pool.imap_unordered(_fill_sample, tasks):
+                    pass
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for task in tasks:
+                _fill_sample(task)
+        data = memmap(filename, dtype=count_dtype, mode="r+", shape=shape)
+    finally:
+        if temporary:
+            try:
+                # the mapping stays valid after the file is removed
+                os.remove(filename)
+            except OSError:
+                pass
+    if not temporary:
+        with open(filename + ".json", "w") as outfile:
+            json.dump({"dtype": count_dtype.str, "shape": shape,
+                       "samples": samples, "references": references,
+                       "lengths": lengths}, outfile)
+    return CoverageMatrix(data, samples, references, lengths)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""
+Reads and writes per base coverage in a binary format which can be
+memory-mapped, so any window of a genome-wide track can be read without
+parsing the whole file.
+
+The file starts with MAGIC, followed by the length of a JSON header as a
+little endian uint64 and the header itself. The header gives the dtype of
+the counts and, for each reference, its length, the order of its strands
+and the element offsets of its "+" and "-" arrays. The arrays follow the
+header, each aligned to ALIGNMENT bytes, in the layout count_coverage
+returns them: index i holds the count at base i (1-based).
+"""
+import json
+import re
+from struct import pack, unpack
+
+from numpy import memmap, zeros, dtype as numpy_dtype, result_type
+
+MAGIC = b"SEQUTILS_COVERAGE\n"
+VERSION = 1
+ALIGNMENT = 64
+
+
+def _padding(position):
+    """the number of bytes needed to align position to ALIGNMENT"""
+    return -position % ALIGNMENT
+
+
+def parse_region(region):
+    """parse a region string like "chrom:start-end" or "chrom"
+
+    start and end are 1-based and inclusive, as in samtools. Returns
+    (reference, start, end), where start and end are None if not given.
+    """
+    match = re.match(r"^(.+?)(?::([\d,]+)(?:-([\d,]+))?)?$", region.strip())
+    if match is None:
+        raise ValueError("invalid region %s" % region)
+    reference, start, end = match.groups()
+    start = int(start.replace(",", "")) if start is not None else None
+    end = int(end.replace(",", "")) if end is not None else None
+    if start is not None and end is None:
+        end = start
+    if start is not None and end < start:
+        raise ValueError("region %s ends before it starts" % region)
+    return reference, start, end
+
+
+def write_coverage_store(all_counts, filename, name=None):
+    """write counts from count_coverage to a binary coverage store
+
+    all_counts: a dict of {reference: {"+": counts, "-": counts}}
+
+    name: An optional track name stored in the header.
+    """
+    if isinstance(name, bytes):
+        name = name.decode("utf-8")
+    arrays = [all_counts[reference][strand] for reference in all_counts
+              for strand in all_counts[reference]]
+    count_dtype = numpy_dtype(result_type(*arrays)) if arrays \
+        else numpy_dtype("uint32")
+    itemsize = count_dtype.itemsize
+    references = []
+    offset = 0
+    for reference in all_counts:
+        entry = {"name": reference,
+                 "length": len(all_counts[reference]["+"]),
+                 "strands": list(all_counts[reference])}
+        for strand in all_counts[reference]:
+            entry[strand] = offset // itemsize
+            offset += len(all_counts[reference][strand]) * itemsize
+            offset += _padding(offset)
+        references.append(entry)
+    header = json.dumps({"version": VERSION, "dtype": count_dtype.str,
+                         "name": name, "size": offset // itemsize,
+                         "references": references}).encode("utf-8")
+    with open(filename, "wb") as outfile:
+        outfile.write(MAGIC)
+        outfile.write(pack("<Q", len(header)))
+        outfile.write(header)
+        outfile.write(b"\0" * _padding(outfile.tell()))
+        for counts in arrays:
+            counts.astype(count_dtype, copy=False).tofile(outfile)
+            outfile.write(b"\0" * _padding(outfile.tell()))
+
+
+class CoverageStore(object):
+    """random access reader for a binary coverage store
+
+    The file is memory-mapped, and every array returned is a read only view
+    into the mapping, so only the pages of the requested window are read.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as infile:
+            if infile.read(len(MAGIC)) != MAGIC:
+                raise IOError("%s is not a coverage store" % filename)
+            header_length = unpack("<Q", infile.read(8))[0]
+            header = json.loads(infile.read(header_length).decode("utf-8"))
+        if header["version"] != VERSION:
+            raise IOError("unsupported coverage store version %s"
+                          % header["version"])
+        self.header = header
+        self.name = header["name"]
+        self.dtype = numpy_dtype(header["dtype"])
+        self.references = [i["name"] for i in header["references"]]
+        self.lengths = dict((i["name"], i["length"])
+                            for i in header["references"])
+        self._offsets = dict((i["name"], i) for i in header["references"])
+        data_offset = len(MAGIC) + 8 + header_length
+        data_offset += _padding(data_offset)
+        if header["size"] == 0:
+            self.data = zeros((0,), dtype=self.dtype)
+        else:
+            self.data = memmap(filename, dtype=self.dtype, mode="r",
+                offset=data_offset, shape=(header["size"],))
+
+    def fetch(self, reference, left=None, right=None, strand="+"):
+        """returns the counts of one strand at bases left to right
+
+        left and right are 1-based and inclusive, like gff positions. If
+        they are not given, the whole reference is returned, with index i
+        holding the count at base i.
+        """
+        if reference not in self._offsets:
+            raise KeyError("reference %s is not in %s"
+                           % (reference, self.filename))
+        length = self.lengths[reference]
+        start = self._offsets[reference][strand]
+        if left is None:
+            left = 0
+        if right is None:
+            right = length - 1
+        left = max(left, 0)
+        right = min(right, length - 1)
+        return self.data[start + left:start + max(right + 1, left)]
+
+    def region(self, region):
+        """returns {"+": counts, "-": counts} for a "chrom:left-right"
+        region string"""
+        reference, left, right = parse_region(region)
+        return dict((strand, self.fetch(reference, left, right, strand))
+                    for strand in ["+", "-"])
+
+    def all_counts(self):
+        """returns {reference: {"+": counts, "-": counts}} for the whole
+        store, in the same layout and order as it was written"""
+        all_counts = {}
+        for reference in self.references:
+            strands = self._offsets[reference].get("strands", ["+", "-"])
+            all_counts[reference] = dict(
+                (strand, self.fetch(reference, strand=strand))
+                for strand in strands)
+        return all_counts
+
+    def close(self):
+        """drop the memory map, which is unmapped once no view of it is
+        left"""
+        self.data = None
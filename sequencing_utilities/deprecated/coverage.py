@@ -1,6 +1,6 @@
 import pandas, numpy
 from matplotlib.pyplot import subplot, fill_between, xlabel, xlim, \
-    ylim, setp, savefig, figure
+    ylim, setp, savefig, figure, broken_barh
 
 
 """Example usage
@@ -31,16 +31,17 @@ def plot_coverage(gff_files, left, right, scale=True, output=None,
     figure(figsize=(4, 1.5 * n_files))
     if names is None:
         names = [i.replace("_", " ").replace(".gtf", "").replace(".gff", "") for i in gff_files]
+    from sequencing_utilities.coverage_gff import iter_coverage_gff, COLUMNS
+
     for i, gff_file in enumerate(gff_files):
-        # sometimes the first line is a comment which pandas can't handle
-        skiprows = 0
-        with open(gff_file, "r") as infile:
-            if infile.read(1) == "#":
-                skiprows = 1
-        table = pandas.read_table(gff_file, header=None,
-            usecols=[0, 2, 3, 4, 5, 6], comment="#", skiprows=skiprows,
-            names=["chromosome", "name", "leftpos", "rightpos", "reads", "strand"])
-        table = table[(table.rightpos >= left) & (table.leftpos <= right)]
+        # only the records of the window are kept while the file is read.
+        # reads are not typed, since annotation tracks have "." instead
+        chunks = list(iter_coverage_gff(gff_file, left=left, right=right,
+                                        reads_dtype=None))
+        if chunks:
+            table = pandas.concat(chunks)
+        else:
+            table = pandas.DataFrame(columns=COLUMNS)
         # TODO - detect if chromsome_plus and chromosome_minus
         if len(table.chromosome.unique()) > 1:
             raise Exception("multiple chromosomes not supported")
@@ -55,46 +56,40 @@ def plot_coverage(gff_files, left, right, scale=True, output=None,
             table_minus["filler"] = 1
             table_plus.fillna(0)
             table_minus.fillna(0)
-        # remove reads that exceed the max coverage
-        if coverage_max:
-            plus_mean = table_plus.reads.mean();
-            minus_mean = table_minus.reads.abs().mean();
-            table_plus = table_plus[table_plus.reads<=coverage_max*float(plus_mean)]
-            table_minus = table_minus[table_minus.reads.abs()<=coverage_max*float(minus_mean)]
-            filler = pandas.Series([range(left, right + 1)], [range(left, right + 1)])
-            table_plus["filler"] = 1
-            table_minus["filler"] = 1
-            table_plus.fillna(plus_mean)
-            table_minus.fillna(minus_mean)
+            # remove reads that exceed the max coverage
+            if coverage_max:
+                plus_mean = table_plus.reads.mean();
+                minus_mean = table_minus.reads.abs().mean();
+                table_plus = table_plus[table_plus.reads<=coverage_max*float(plus_mean)]
+                table_minus = table_minus[table_minus.reads.abs()<=coverage_max*float(minus_mean)]
+                filler = pandas.Series([range(left, right + 1)], [range(left, right + 1)])
+                table_plus["filler"] = 1
+                table_minus["filler"] = 1
+                table_plus.fillna(plus_mean)
+                table_minus.fillna(minus_mean)
             # extract only the series we need
             plus = table_plus.reads
             minus = table_minus.reads.abs()  # in case stored negative
             if scale:
                 plus *= 100. / plus.max()
                 minus *= 100. / minus.max()
-            # downsample to 2000 pts
-            collapse_factor = int((right - left) / 2000)
-            if collapse_factor > 1:
-                plus = plus.groupby(lambda x: x // collapse_factor).mean()
-                plus.index *= collapse_factor
-                minus = minus.groupby(lambda x: x // collapse_factor).mean()
-                minus.index *= collapse_factor
-            
-            fill_between(minus.index.values, 0, minus.values, color="orange", alpha=0.75)
-            fill_between(plus.index.values, 0, plus.values, color="blue", alpha=0.5)
+            # downsample to plot_points
+            collapse_factor = int((right - left) / plot_points)
+            fill_strands(plus, minus, collapse_factor)
         else:
             if len(table) == 0:
                 continue
             if (table.reads == ".").all():  # annotation track
                 ylim(0, 100)
                 ax.yaxis.set_visible(False)
-                for j in table.index:
-                    entry = table.ix[j]
-                    x = [entry["leftpos"], entry["rightpos"]]
-                    if entry["strand"] == "+":
-                        fill_between(x, 50., 80.)
-                    else:
-                        fill_between(x, 50., 20.)
+                # draw all features of a strand in one call
+                for strand, yrange in (("+", (50., 30.)), ("-", (20., 30.))):
+                    features = table[table.strand == strand]
+                    if len(features) == 0:
+                        continue
+                    widths = features.rightpos.values - features.leftpos.values
+                    broken_barh(list(zip(features.leftpos.values, widths)),
+                                yrange)
             else:
                 raise Exception("not yet supported")
         xlabel(names[i])
@@ -119,7 +114,8 @@ def plot_coverage(gff_files, left, right, scale=True, output=None,
     if output:
         savefig(output, transparent=True)
 
-def extract_strandsFromGff(gff_file, left, right, scale=True, downsample=0):
+def extract_strandsFromGff(gff_file, left, right, scale=True, downsample=0,
+                           reference=None):
     """convert a gff file to a table of positions and reads
 
     Input:
@@ -128,24 +124,25 @@ def extract_strandsFromGff(gff_file, left, right, scale=True, downsample=0):
     right: right position to end analysis
     scale: reads will be normalized to have 100 max
     downsample: the number of positions to downsample to
+    reference: the chromosome to read, which may be omitted if the window
+        has only one
 
     Output:
     plus: table [index,reads] for the plus strand
     minus: table [index,reads] for the minus strand
     """
+    from sequencing_utilities.coverage_gff import iter_coverage_gff, COLUMNS
 
-    # sometimes the first line is a comment which pandas can't handle
-    skiprows = 0
-    with open(gff_file, "r") as infile:
-        if infile.read(1) == "#":
-            skiprows = 1
-    table = pandas.read_table(gff_file, header=None,
-        usecols=[0, 2, 3, 4, 5, 6], comment="#", skiprows=skiprows,
-        names=["chromosome", "name", "leftpos", "rightpos", "reads", "strand"])
-    table = table[(table.rightpos >= left) & (table.leftpos <= right)]
+    # only the records of the window are kept while the file is read
+    chunks = list(iter_coverage_gff(gff_file, reference, left, right,
+                                    reads_dtype=None))
+    if chunks:
+        table = pandas.concat(chunks)
+    else:
+        table = pandas.DataFrame(columns=COLUMNS)
     # TODO - detect if chromsome_plus and chromosome_minus
     if len(table.chromosome.unique()) > 1:
-        raise Exception("multiple chromosomes not supported")
+        raise Exception("multiple chromosomes not supported, give a reference")
     if (table.leftpos == table.rightpos).all():  # each line is one point
         table = table[["leftpos", "reads", "strand"]]
     table_plus = table[table.strand == "+"].set_index("leftpos")
@@ -167,10 +164,51 @@ def extract_strandsFromGff(gff_file, left, right, scale=True, downsample=0):
     if downsample > 1:
         collapse_factor = int((right - left) / downsample)
     if collapse_factor and collapse_factor > 1:
-        plus = plus.groupby(lambda x: x // collapse_factor).mean()
-        plus.index *= collapse_factor
-        minus = minus.groupby(lambda x: x // collapse_factor).mean()
-        minus.index *= collapse_factor
+        plus = downsample_envelope(plus, collapse_factor)[0]
+        minus = downsample_envelope(minus, collapse_factor)[0]
+    return plus,minus;
+
+def extract_strandsFromStore(store_file, left, right, scale=True, downsample=0,
+                             reference=None):
+    """read a window of a binary coverage store written by makegff
+
+    Only the requested window is read from the memory-mapped store, instead
+    of parsing a whole gff file.
+
+    Input:
+    store_file: coverage store to read
+    left: left position to start analysis
+    right: right position to end analysis
+    scale: reads will be normalized to have 100 max
+    downsample: the number of positions to downsample to
+    reference: the reference to read, which may be omitted if the store has
+        only one
+
+    Output:
+    plus: table [index,reads] for the plus strand
+    minus: table [index,reads] for the minus strand
+    """
+    from sequencing_utilities.coverage_store import CoverageStore
+
+    store = CoverageStore(store_file)
+    if reference is None:
+        if len(store.references) > 1:
+            raise Exception("reference must be given for multiple chromosomes")
+        reference = store.references[0]
+    index = numpy.arange(max(left, 0), min(right, store.lengths[reference] - 1) + 1)
+    plus = pandas.Series(store.fetch(reference, left, right, "+"), index=index, dtype=float)
+    minus = pandas.Series(store.fetch(reference, left, right, "-"), index=index, dtype=float)
+    store.close()
+    if scale:
+        plus *= 100. / plus.max()
+        minus *= 100. / minus.max()
+    # downsample
+    collapse_factor = None;
+    if downsample > 1:
+        collapse_factor = int((right - left) / downsample)
+    if collapse_factor and collapse_factor > 1:
+        plus = downsample_envelope(plus, collapse_factor)[0]
+        minus = downsample_envelope(minus, collapse_factor)[0]
     return plus,minus;
 
 def find_highCoverageRegions(plus,minus,coverage_min=1.5,coverage_max=5.0,
@@ -180,105 +218,69 @@ def find_highCoverageRegions(plus,minus,coverage_min=1.5,coverage_max=5.0,
     Input:
     plus: plus strand
     minus: minus strand
-    coverage_min: minimum coverage of a high coverage region
-    coverage_max: maximum coverage of a high coverage region
+    coverage_min: minimum coverage of a high coverage region, as a multiple
+        of the mean coverage of the strand
+    coverage_max: maximum coverage of a high coverage region, as a multiple
+        of the mean coverage of the strand
     points_min: minimum number of consequtive points of a high coverage region
+    consecutive_tol: maximum distance between consecutive points of a region
 
     Output:
+    plus_high_region_summary: list of {'start','stop','mean'} for each region
+        on the plus strand
+    minus_high_region_summary: same for the minus strand
+    plus_high_regions: the points of all regions on the plus strand
+    minus_high_regions: the points of all regions on the minus strand
     '''
+    plus_high_region_summary,plus_high_regions = _find_highCoverageRegions(
+        plus,coverage_min,coverage_max,points_min,consecutive_tol);
+    minus_high_region_summary,minus_high_regions = _find_highCoverageRegions(
+        minus,coverage_min,coverage_max,points_min,consecutive_tol);
+    return plus_high_region_summary,minus_high_region_summary,plus_high_regions, minus_high_regions
+
+def _find_highCoverageRegions(strand,coverage_min,coverage_max,points_min,
+    consecutive_tol):
+    '''Find regions of high coverage on one strand with run-length segmentation
 
+    The points within the min/max coverage are split into runs wherever two
+    consecutive points are more than consecutive_tol apart. The first point
+    of a run only marks its start, and the last point of the strand only
+    marks the stop of the last run, so a run covers the points after its
+    start up to the point which starts the next run (its stop). A run is
+    kept if it covers at least points_min points.
+
+    Output:
+    summary: list of {'start','stop','mean'} for each region
+    high_regions: the points of all regions with coverage above 0
+    '''
     # find indices that are within the min/max coverage
-    plus_high = plus[(plus>=coverage_min*float(plus.mean())) & (plus<=coverage_max*float(plus.mean()))];
-    minus_high = minus[(minus>=coverage_min*float(minus.mean())) & (minus<=coverage_max*float(minus.mean()))];
-    # find indices that meet the minimum number of consecutive points and consecutive point count tolerance limit
-    plus_high_regions = plus_high*0;
-    minus_high_regions = minus_high*0;
-    plus_high_region_summary = [];
-    minus_high_region_summary = [];
-    cnt = 0;
-    for index,value in plus_high.iteritems():
-        # initialize all tmp variables and iterators
-        if cnt==0: 
-            high_regions_tmp = plus_high*0;
-            previous = index;
-            consecutive_points = 0;
-            start=index;
-            cnt += 1;
-            continue;
-        # check for regions of high coverage that
-        if index-previous<=consecutive_tol: # 1 satisfy the consecutive tol
-            # case for all points but the last point
-            # update current high region and iterate counters
-            if cnt<len(plus_high)-1:
-                high_regions_tmp[index]=value;
-                consecutive_points += 1;
-                previous = index;
-            # case for the last point
-            # update all high regions (points_min satisfied)
-            elif consecutive_points >= points_min: # 2 satisfy the consecutive points
-                plus_high_regions=record_highCoverageRegions(high_regions_tmp,plus_high_regions)
-                plus_high_region_summary.append({'start':start,'stop':index,'mean':high_regions_tmp[high_regions_tmp>0].mean()});    
-        else:
-            # update all high regions and reset (points_min satisfied)
-            if consecutive_points >= points_min:
-                plus_high_regions=record_highCoverageRegions(high_regions_tmp,plus_high_regions)
-                plus_high_region_summary.append({'start':start,'stop':index,'mean':high_regions_tmp[high_regions_tmp>0].mean()});
-                previous = index;
-                consecutive_points = 0;
-                start=index;
-                high_regions_tmp = plus_high*0;
-                # reset variables and counters
-            else:
-                high_regions_tmp = plus_high*0;
-                previous = index;
-                consecutive_points = 0;
-                start=index;
-        # update the counter
-        cnt += 1;
-    cnt = 0;
-    for index,value in minus_high.iteritems():
-        # initialize all tmp variables and iterators
-        if cnt==0: 
-            high_regions_tmp = minus_high*0;
-            previous = index;
-            consecutive_points = 0;
-            start=index;
-            cnt += 1;
-            continue;
-        # check for regions of high coverage that
-        if index-previous<=consecutive_tol: # 1 satisfy the consecutive tol
-            # case for all points but the last point
-            # update current high region and iterate counters
-            if cnt<len(minus_high)-1:
-                high_regions_tmp[index]=value;
-                consecutive_points += 1;
-                previous = index;
-            # case for the last point
-            # update all high regions (points_min satisfied)
-            elif consecutive_points >= points_min: # 2 satisfy the consecutive points
-                minus_high_regions=record_highCoverageRegions(high_regions_tmp,minus_high_regions)
-                minus_high_region_summary.append({'start':start,'stop':index,'mean':high_regions_tmp[high_regions_tmp>0].mean()});    
-        else:
-            # update all high regions and reset (points_min satisfied)
-            if consecutive_points >= points_min:
-                minus_high_regions=record_highCoverageRegions(high_regions_tmp,minus_high_regions)
-                minus_high_region_summary.append({'start':start,'stop':index,'mean':high_regions_tmp[high_regions_tmp>0].mean()});
-                previous = index;
-                consecutive_points = 0;
-                start=index;
-                high_regions_tmp = minus_high*0;
-                # reset variables and counters
-            else:
-                high_regions_tmp = minus_high*0;
-                previous = index;
-                consecutive_points = 0;
-                start=index;
-        # update the counter
-        cnt += 1;
-    # filter out all 0 values
-    plus_high_regions = plus_high_regions[plus_high_regions>0];
-    minus_high_regions = minus_high_regions[minus_high_regions>0];
-    return plus_high_region_summary,minus_high_region_summary,plus_high_regions, minus_high_regions
+    mean = float(strand.mean());
+    high = strand[(strand>=coverage_min*mean) & (strand<=coverage_max*mean)];
+    index = high.index.values;
+    values = high.values;
+    n_points = len(high);
+    if n_points < 2:
+        return [],high[numpy.zeros(n_points,dtype=bool)]
+    # a run starts at the first point and after every gap above the tolerance
+    run_starts = numpy.concatenate(([0],
+        numpy.nonzero(numpy.diff(index)>consecutive_tol)[0]+1));
+    run_stops = numpy.append(run_starts[1:],n_points-1);
+    # points after the start of a run up to the stop are part of the region
+    points = run_stops-run_starts-1;
+    keep = (points>=points_min) & (run_stops>run_starts);
+    in_region = numpy.zeros(n_points+1,dtype=numpy.int64);
+    numpy.add.at(in_region,run_starts[keep]+1,1);
+    numpy.subtract.at(in_region,run_stops[keep],1);
+    in_region = numpy.cumsum(in_region[:-1])>0;
+    index_list = index.tolist();
+    summary = [];
+    for run_start,run_stop in zip(run_starts[keep],run_stops[keep]):
+        region = values[run_start+1:run_stop];
+        region = region[region>0];
+        summary.append({'start':index_list[run_start],
+            'stop':index_list[run_stop],
+            'mean':region.mean(dtype=numpy.float64) if len(region) else numpy.nan});
+    return summary,high[in_region & (values>0)]
 
 def record_highCoverageRegions(high_region,high_regions):
     '''Record high coverage region index and reads to master list of all high regions indices and reads'''
@@ -286,6 +288,58 @@ def record_highCoverageRegions(high_region,high_regions):
     return high_regions
     
 
+def downsample_envelope(series, collapse_factor):
+    '''Downsample a series to one point per bin of collapse_factor positions
+
+    Bins are found from the sorted index in one pass, and the mean, minimum
+    and maximum of every bin are computed with numpy reductions, instead of
+    calling a function for every index. Only positions present in the
+    series are part of a bin.
+
+    Input:
+    series: table [index,reads]
+    collapse_factor: the number of positions in each bin
+
+    Output:
+    mean: table [index,reads] of the mean of each bin, where the index is
+        the first position of the bin
+    minimum: table [index,reads] of the minimum of each bin
+    maximum: table [index,reads] of the maximum of each bin
+    '''
+    if not series.index.is_monotonic_increasing:
+        series = series.sort_index()
+    keys = numpy.asarray(series.index.values) // collapse_factor
+    values = numpy.asarray(series.values, dtype=float)
+    if len(values) == 0:
+        empty = pandas.Series([], dtype=float)
+        return empty, empty.copy(), empty.copy()
+    starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(keys)) + 1))
+    counts = numpy.diff(numpy.append(starts, len(values)))
+    index = keys[starts] * collapse_factor
+    mean = pandas.Series(numpy.add.reduceat(values, starts) / counts, index=index)
+    minimum = pandas.Series(numpy.minimum.reduceat(values, starts), index=index)
+    maximum = pandas.Series(numpy.maximum.reduceat(values, starts), index=index)
+    return mean, minimum, maximum
+
+def fill_strands(plus, minus, collapse_factor=None):
+    '''Fill the coverage of both strands on the current axes
+
+    When collapse_factor is above 1, each strand is downsampled to the mean
+    of every bin, and the minimum to maximum of each bin is drawn behind it
+    so narrow peaks stay visible.
+
+    Input:
+    plus: table [index,reads] for the plus strand
+    minus: table [index,reads] for the minus strand
+    collapse_factor: the number of positions in each plotted point
+    '''
+    for strand, color, alpha in ((minus, "orange", 0.75), (plus, "blue", 0.5)):
+        if collapse_factor and collapse_factor > 1:
+            strand, minimum, maximum = downsample_envelope(strand, collapse_factor)
+            fill_between(maximum.index.values, minimum.values, maximum.values,
+                         color=color, alpha=alpha * 0.4)
+        fill_between(strand.index.values, 0, strand.values, color=color, alpha=alpha)
+
 def plot_strands(plus,minus,left,right,scale=True, output=None,
                   coverage_max=5.0, downsample=2000):
     '''Plot strand coverage
@@ -316,16 +370,10 @@ def plot_strands(plus,minus,left,right,scale=True, output=None,
     collapse_factor = None;
     if downsample > 1:
         collapse_factor = int((right - left) / downsample)
-    if collapse_factor and collapse_factor > 1:
-        plus = plus.groupby(lambda x: x // collapse_factor).mean()
-        plus.index *= collapse_factor
-        minus = minus.groupby(lambda x: x // collapse_factor).mean()
-        minus.index *= collapse_factor;
     # plot the figure:
     fig=figure()
     ax = subplot(1,1,1)
-    fill_between(minus.index.values, 0, minus.values, color="orange", alpha=0.75)
-    fill_between(plus.index.values, 0, plus.values, color="blue", alpha=0.5)
+    fill_strands(plus, minus, collapse_factor)
     xlim(left, right)
     if scale:
         ylim(0, 100)
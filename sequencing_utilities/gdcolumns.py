@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+"""
+Builds columnar tables of GenomeDiff entries, one pandas DataFrame per
+entry type, straight from the records gdparse streams, so mutations and
+evidence can be filtered and aggregated with vectorized operations instead
+of by walking GDParser.data.
+"""
+from glob import glob
+from multiprocessing import Pool
+
+from numpy import empty, full, array, int64, float64, nan
+
+import pandas
+from pandas.api.types import infer_dtype
+
+from .gdparse import GDParser
+
+FIELD_DTYPES = {"int": int64, "float": float64}
+
+
+def _column(rows, values, n_rows, dtype=None):
+    """make an array of n_rows from the values at rows
+
+    dtype: The type of a fixed field, or None to infer it from the values:
+    int64 if they are all ints and none is missing, float64 (with missing
+    values as NaN) if they are all numbers, and object otherwise (with
+    missing values as None).
+    """
+    if dtype is None:
+        types = set(map(type, values))
+        if types <= {int, float}:
+            dtype = int64 if types == {int} and len(rows) == n_rows \
+                else float64
+    if len(rows) == n_rows:
+        if dtype is None:
+            column = empty((n_rows,), dtype=object)
+            column[:] = values
+            return column
+        return array(values, dtype=dtype)
+    if dtype is None:
+        column = full((n_rows,), None, dtype=object)
+    else:
+        # missing values are NaN, so ints become floats
+        column = full((n_rows,), nan)
+    column[rows] = values
+    return column
+
+
+class GDColumnBuilder(object):
+    """collects records from GDParser.iterRecords into one table per type
+
+    Each column is kept as the list of rows it has a value in and the list
+    of those values, so entries with different optional fields do not have
+    to be aligned until the tables are built.
+    """
+
+    def __init__(self):
+        self.n_rows = {}
+        self.columns = {}
+
+    def add(self, item_class, item_id, record):
+        """add one (item class, item id, item) record"""
+        record_type = record["type"]
+        columns = self.columns.get(record_type)
+        if columns is None:
+            columns = self.columns[record_type] = {"id": ([], [])}
+            self.n_rows[record_type] = 0
+        row = self.n_rows[record_type]
+        rows, values = columns["id"]
+        rows.append(row)
+        values.append(item_id)
+        for key, value in record.items():
+            column = columns.get(key)
+            if column is None:
+                column = columns[key] = ([], [])
+            column[0].append(row)
+            column[1].append(value)
+        self.n_rows[record_type] = row + 1
+
+    def tables(self):
+        """returns {type: DataFrame} with a column for the id, the type, the
+        parent_ids, each fixed field of the type, typed as GDParser defines
+        it, and each optional key=value field, typed from its values"""
+        tables = {}
+        for record_type, columns in self.columns.items():
+            n_rows = self.n_rows[record_type]
+            dtypes = {"id": int64}
+            for field_def in GDParser.record_fields.get(record_type, []):
+                dtypes[field_def["name"]] = FIELD_DTYPES.get(field_def["type"])
+            tables[record_type] = pandas.DataFrame(dict(
+                (key, _column(rows, values, n_rows, dtypes.get(key)))
+                for key, (rows, values) in columns.items()))
+        return tables
+
+
+def read_gd_columns(file_handle, classes=None, types=None,
+        ignore_errors=False):
+    """read a GenomeDiff file into {type: DataFrame}, one row per entry
+
+    The file is streamed through GDParser.iterRecords, so only the columns
+    are kept in memory. classes, types and ignore_errors are passed on to
+    it.
+    """
+    builder = GDColumnBuilder()
+    parser = GDParser()
+    for item_class, item_id, record in parser.iterRecords(file_handle,
+            classes, types, ignore_errors):
+        builder.add(item_class, item_id, record)
+    return builder.tables()
+
+
+def _compact(table):
+    """make the string columns with repeated values, like seq_id or
+    gene_name, categorical, so they are pickled as small integer codes"""
+    for column in table.columns:
+        if infer_dtype(table[column], skipna=True) == "string" and \
+                table[column].nunique() * 2 < len(table):
+            table[column] = table[column].astype("category")
+    return table
+
+
+def _read_gd_file(args):
+    """read the tables of one file in a worker, which returns them as
+    compact DataFrames of arrays instead of a tree of dicts"""
+    filename, classes, types, ignore_errors = args
+    with open(filename) as handle:
+        tables = read_gd_columns(handle, classes, types, ignore_errors)
+    return dict((record_type, _compact(table))
+                for record_type, table in tables.items())
+
+
+def read_gd_files(filenames, samples=None, workers=1, merge=True,
+        classes=None, types=None, ignore_errors=False):
+    """read several GenomeDiff files, such as the output.gd of each clone,
+    with read_gd_columns in a pool of workers processes
+
+    filenames: A list of files, or a glob pattern like "*/output/output.gd".
+
+    samples: A label for each file. Defaults to the filenames.
+
+    merge: Return {type: DataFrame} with the entries of all files and a
+    sample column. If False, return {sample: {type: DataFrame}}.
+
+    classes, types and ignore_errors: See GDParser.iterRecords.
+    """
+    if isinstance(filenames, str):
+        filenames = sorted(glob(filenames))
+    filenames = list(filenames)
+    if len(filenames) == 0:
+        raise ValueError("no GenomeDiff files to read")
+    if samples is None:
+        samples = filenames
+    if len(samples) != len(filenames):
+        raise ValueError("need one sample label for each file")
+    tasks = [(filename, classes, types, ignore_errors)
+             for filename in filenames]
+    if workers > 1:
+        pool = Pool(min(workers, len(tasks)))
+        try:
+            results = pool.map(_read_gd_file, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_read_gd_file(task) for task in tasks]
+    if not merge:
+        return dict(zip(samples, results))
+    merged = {}
+    for sample, tables in zip(samples, results):
+        for record_type, table in tables.items():
+            table.insert(0, "sample", sample)
+            merged.setdefault(record_type, []).append(table)
+    for record_type, tables in merged.items():
+        categorical = set(["sample"] + [column for table in tables
+            for column in table.columns
+            if isinstance(table[column].dtype, pandas.CategoricalDtype)])
+        table = pandas.concat(tables, ignore_index=True)
+        # categoricals with different categories are concatenated as strings
+        for column in categorical:
+            table[column] = table[column].astype("category")
+        merged[record_type] = table
+    return merged
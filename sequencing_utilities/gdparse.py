@@ -5,15 +5,15 @@ Implements the GDParser class (that parses GenomeDiff files) and associated subr
 """
 import re
 
-def smartconvert(data_string):
+def _smartconvertSlow(data_string):
     """
-    Attempts to convert a raw string into the following data types, returns the first successful:
+    Attempts to convert a stripped string into the following data types, returns the first successful:
         int, float, str
     """
     type_list = [int, float]
     for var_type in type_list:
         try:
-            converted_var=var_type(data_string.strip())
+            converted_var=var_type(data_string)
             #Check for inifinite values:
             if converted_var == float('Inf'):
                 converted_var = 1e6;
@@ -21,7 +21,59 @@ def smartconvert(data_string):
         except ValueError:
             pass
     #No match found
-    return str(data_string.strip())
+    return data_string
+
+#the characters int() or float() accept as the first character of a string, besides unicode digits
+_number_start=frozenset('+-.0123456789iInN')
+_int_pattern=re.compile(r'[+-]?[0-9]+\Z')
+_float_pattern=re.compile(r'[+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?\Z')
+#any ASCII character that can not be part of a string int() or float() accept, like the / of 12/34
+_non_number_char=re.compile(r'[^0-9+\-._eEiInNfFtTyYaA]')
+#the type the last value of each optional field key was converted to
+_key_types={}
+_max_key_types=4096
+
+def _convert(value):
+    """
+    Converts a stripped string like _smartconvertSlow, but only raises and catches exceptions
+    for strings that are not plain ASCII decimal numbers and could still be numbers.
+    """
+    first=value[:1]
+    if first not in _number_start and not first.isdecimal():
+        return value
+    if _int_pattern.match(value):
+        return int(value)
+    if _float_pattern.match(value):
+        converted_var=float(value)
+        #Check for inifinite values:
+        if converted_var == float('Inf'):
+            converted_var = 1e6;
+        return converted_var
+    if value.isascii() and _non_number_char.search(value):
+        return value
+    #inf, nan, underscores, unicode digits or not a number at all
+    return _smartconvertSlow(value)
+
+def smartconvert(data_string, key=None):
+    """
+    Attempts to convert a raw string into the following data types, returns the first successful:
+        int, float, str
+    
+    key: the name of the optional field the string is the value of. The type of the last value
+        of each key is remembered and checked first, since most keys always have the same type.
+    """
+    value=data_string.strip()
+    key_type=_key_types.get(key)
+    if key_type is str:
+        first=value[:1]
+        if first not in _number_start and not first.isdecimal():
+            return value
+    elif key_type is int and _int_pattern.match(value):
+        return int(value)
+    converted_var=_convert(value)
+    if key is not None and (key in _key_types or len(_key_types) < _max_key_types):
+        _key_types[key]=type(converted_var)
+    return converted_var
 
 class GDParseError(Exception):
     """
@@ -42,6 +94,99 @@ class GDFieldError(GDParseError):
         self.msg=msg
         self.inner_exception_msg=inner_exception_msg
 
+def _intTuple(field):
+    """
+    Converts any comma-separated list to a tuple of ints. Currently only used for sequence ranges.
+    """
+    return tuple([int(e) for e in field.split(',')])
+
+#converter for each field type, and the message of the GDFieldError raised when it fails
+_field_converters={
+    'string':(str,"Cannot convert to string"),
+    'char':(str,"Cannot convert to char"),
+    'int':(int,"Cannot convert to integer"),
+    'float':(float,"Cannot convert to float"),
+    'int_tuple':(_intTuple,"Cannot convert to integer"),
+}
+
+def _fieldValidators(field_def):
+    """
+    Returns a tuple of validators for a field definition (see GDParser.record_fields). Each validator
+    takes the converted value and returns None if it is valid, or the error message otherwise.
+    """
+    validators=[]
+    if field_def['type']=='char':
+        validators.append(lambda value: "Char field must have length 1" if len(value)>1 else None)
+    elif field_def['type']=='int_tuple':
+        validators.append(lambda value: "Expected more than {} items".format(len(value)) if len(value)<2 else None)
+    if 'max_length' in field_def:
+        max_length=field_def['max_length']
+        validators.append(lambda value: "Length of string field {} exceeds max length of {}".format(len(value),max_length) if len(value)>max_length else None)
+    if 'max_value' in field_def:
+        max_value=field_def['max_value']
+        validators.append(lambda value: "Value {} exceeds maximum allowable value of {}".format(value,max_value) if value>max_value else None)
+    if 'min_value' in field_def:
+        min_value=field_def['min_value']
+        validators.append(lambda value: "Value {} below minimum allowable value of {}".format(value,min_value) if value<min_value else None)
+    if 'max_abs' in field_def:
+        max_abs=field_def['max_abs']
+        validators.append(lambda value: "Value {} exceeds maximum allowable absolute value of {}".format(value,max_abs) if abs(value)>max_abs else None)
+    if 'min_abs' in field_def:
+        min_abs=field_def['min_abs']
+        validators.append(lambda value: "Value {} below minimum allowable absolute value of {}".format(value,min_abs) if abs(value)<min_abs else None)
+    if 'allowable_values' in field_def:
+        allowable_values=field_def['allowable_values']
+        validators.append(lambda value: "Value {} not permitted. Allowed values={}".format(value,allowable_values) if value not in allowable_values else None)
+    return tuple(validators)
+
+def _compileFieldDefs(field_defs,start_field=3):
+    """
+    Compiles a list of field definitions into a tuple with one
+    (field number, name, converter, conversion error message, validators) tuple per field,
+    so a line can be parsed without looking anything up in the definitions.
+    """
+    return tuple([(start_field+field_idx,field_def['name'])+_field_converters[field_def['type']]+(_fieldValidators(field_def),)
+        for field_idx,field_def in enumerate(field_defs)])
+
+def _parseFields(source_data,target_data,fields,start_field=3):
+    """
+    Parses the fields compiled by _compileFieldDefs from a row of elements into a dictionary of named data elements.
+
+    Returns the next field index after the processed ones.
+    """
+    next_field=start_field+len(fields)
+    if len(source_data) < next_field: #Check that we have enough fields to work with
+        raise GDParseError("Premature line termination, needed at least {} fields, only got {}".format(next_field, len(source_data)))
+    for field_num,name,converter,error_msg,validators in fields:
+        field=source_data[field_num]
+        try:
+            parsed_value=converter(field)
+        except ValueError as ve:
+            raise GDFieldError(field_num,name,field,error_msg,str(ve))
+        for validator in validators:
+            msg=validator(parsed_value)
+            if msg is not None:
+                raise GDFieldError(field_num,name,field,msg)
+        target_data[name]=parsed_value
+    return next_field
+
+def _checkPrimers(data):
+    """
+    Checks that both primers of a validation entry end after they start.
+    """
+    if data['primer1_start'] >= data['primer1_end']:
+        raise GDFieldError(6,'primer1_end',data['primer1_end'],"Primer 1 end location {} must be > primer start location {}".format(data['primer1_end'],data['primer1_start']))
+    if data['primer2_start'] >= data['primer2_end']:
+        raise GDFieldError(8,'primer2_end',data['primer2_end'],"Primer 2 end location {} must be > primer start location {}".format(data['primer2_end'],data['primer2_start']))
+
+def _compileRecordParsers(record_fields,record_checks):
+    """
+    Compiles the field definitions of each entry type into a dictionary of
+    (compiled fields, check of the whole record or None) tuples, keyed by type.
+    """
+    return dict([(record_type,(_compileFieldDefs(field_defs),record_checks.get(record_type)))
+        for record_type,field_defs in record_fields.items()])
+
 class GDParser():
     """
     Implements a parser that reads a GenomeDiff file and stores the information in two property dictionaries:
@@ -60,7 +205,119 @@ class GDParser():
     evidence_types=['RA', 'MC', 'JC', 'UN']
     validation_types=['TSEQ', 'PFLP', 'RFLP', 'PFGE', 'PHYL', 'CURA']
     id2line_num={}
-    
+
+    #Definitions of the fields of each entry type, which follow the type, id and parent-ids fields.
+    #Required sub-fields:
+    #    name:    any valid string
+    #    type:    int, float, char, string, int_tuple
+    #Optional sub-fields:
+    #    allowable_values:    list that contains the values allowed in the field
+    #Optional sub-fields for string fields:
+    #    max_length:    integer describing the maximum allowed length.
+    #Optional sub-fields for numeric fields:
+    #    min_value:    number describing the minimum value allowed for a numeric field.
+    #    max_value:    number describing the maximum value allowed for a numeric field.
+    #    max_abs:    number describing the maximum absolute value allowed for a numeric field.
+    #    min_abs:    number describing the minimum absolute value allowed for a numeric field.
+    record_fields={
+        'SNP':[ # Base substitution mutation
+            {'name':'seq_id','type':'string'}, #id of reference sequence fragment containing mutation, evidence, or validation.
+            {'name':'position','type':'int'}, #position in reference sequence fragment.
+            {'name':'new_seq','type':'char'}], #new base at position
+        'SUB':[ # Multiple base substitution mutation
+            {'name':'seq_id','type':'string'},
+            {'name':'position','type':'int'}, #position of the first replaced nucleotide in reference sequence fragment.
+            {'name':'size','type':'int'}, #number of bases after the specified reference position to replace with new_seq
+            {'name':'new_seq','type':'string'}], #new bases at position
+        'DEL':[ # Deletion mutation
+            {'name':'seq_id','type':'string'},
+            {'name':'position','type':'int'},
+            {'name':'size','type':'int'}], #number of bases deleted in reference, including reference position.
+        'INS':[ # Insertion mutation
+            {'name':'seq_id','type':'string'},
+            {'name':'position','type':'int'}, #position in reference sequence fragment, after which the INS is placed.
+            {'name':'new_seq','type':'string'}], #new bases inserted after the specified reference position
+        'MOB':[ # Mobile element insertion mutation
+            {'name':'seq_id','type':'string'},
+            {'name':'position','type':'int'},
+            {'name':'repeat_name','type':'string'}, #name of the mobile element. Should correspond to an annotated repeat_region in the reference.
+            {'name':'strand','type':'int','allowable_values':[-1,1]}, #strand of mobile element insertion.
+            {'name':'duplication_size','type':'int'}], #number of bases duplicated during insertion, beginning with the specified reference position.
+        'AMP':[ # Amplification Mutation
+            {'name':'seq_id','type':'string'},
+            {'name':'position','type':'int'},
+            {'name':'size','type':'int'}, #number of bases duplicated starting with the specified reference position.
+            {'name':'new_copy_number','type':'int'}], #new number of copies of specified bases.
+        'CON':[ # Gene conversion mutation
+            {'name':'seq_id','type':'string'},
+            {'name':'position','type':'int'}, #position in reference sequence fragment that was the target of gene conversion from another genomic location.
+            {'name':'size','type':'int'}, #number of bases to replace in the reference genome beginning at the specified position.
+            {'name':'region','type':'int_tuple'}], #region in the reference genome to use as a replacement.
+        'INV':[ #Inversion mutation
+            {'name':'seq_id','type':'string'},
+            {'name':'position','type':'int'},
+            {'name':'size','type':'int'}], #number of bases in inverted region beginning at the specified reference position.
+        'RA':[ # Read alignment evidence
+            {'name':'seq_id','type':'string'},
+            {'name':'position','type':'int'},
+            {'name':'insert_position','type':'int'}, #number of bases inserted after the reference position to get to this base. An value of zero refers to the base.
+            {'name':'ref_base','type':'char'}, #base in the reference genome.
+            {'name':'new_base','type':'char'}], #new base supported by read alignment evidence.
+        'MC':[ # Missing coverage evidence
+            {'name':'seq_id','type':'string'},
+            {'name':'start','type':'int'}, #start position in reference sequence fragment.
+            {'name':'end','type':'int'}, #end position in reference sequence of region.
+            {'name':'start_range','type':'int'}, #number of bases to offset after the start position to define the upper limit of the range where the start of a deletion could be.
+            {'name':'end_range','type':'int'}], #number of bases to offset before the end position to define the lower limit of the range where the start of a deletion could be.
+        'JC':[ # New junction evidence
+            {'name':'side_1_seq_id','type':'string'}, #id of reference sequence fragment containing side 1 of the junction.
+            {'name':'side_1_position','type':'int'}, #position of side 1 at the junction boundary.
+            {'name':'side_1_strand','type':'int','allowable_values':[-1,1]}, #direction that side 1 continues matching the reference sequence
+            {'name':'side_2_seq_id','type':'string'},
+            {'name':'side_2_position','type':'int'},
+            {'name':'side_2_strand','type':'int','allowable_values':[-1,1]},
+            {'name':'overlap','type':'int'}], #number of bases that the two sides of the new junction have in common.
+        'UN':[ # Unknown base evidence
+            {'name':'seq_id','type':'string'},
+            {'name':'start','type':'int'},
+            {'name':'end','type':'int'}],
+        'CURA':[ # True-positive curated by an expert
+            {'name':'expert','type':'string'}], #Name or initials of the person who predicted the mutation.
+        'FPOS':[ #  False-positive curated by an expert
+            {'name':'expert','type':'string'}],
+        'PHYL':[ # Phylogenetic comparison
+            {'name':'gd','type':'string'}], #Name of the genome_diff file containing the evidence.
+        'TSEQ':[ # Targeted resequencing
+            {'name':'seq_id','type':'string'},
+            {'name':'primer1_start','type':'int'}, #position in reference sequence of the 5' end of primer 1.
+            {'name':'primer1_end','type':'int'}, #position in reference sequence of the 3' end of primer 1.
+            {'name':'primer2_start','type':'int'}, #position in reference sequence of the 5' end of primer 2.
+            {'name':'primer2_end','type':'int'}], #position in reference sequence of the 3' end of primer 2.
+        'PFLP':[ #PCR-fragment length polymorphism
+            {'name':'seq_id','type':'string'},
+            {'name':'primer1_start','type':'int'},
+            {'name':'primer1_end','type':'int'},
+            {'name':'primer2_start','type':'int'},
+            {'name':'primer2_end','type':'int'}],
+        'RFLP':[ #Restriction fragment length polymorphism
+            {'name':'seq_id','type':'string'},
+            {'name':'primer1_start','type':'int'},
+            {'name':'primer1_end','type':'int'},
+            {'name':'primer2_start','type':'int'},
+            {'name':'primer2_end','type':'int'},
+            {'name':'enzyme','type':'string'}], #Restriction enzyme used to distinguish reference from mutated allele.
+        'PFGE':[ #Pulsed-field gel electrophoresis
+            {'name':'seq_id','type':'string'},
+            {'name':'enzyme','type':'string'}], #Restriction enzyme used to digest genomic DNA and observe fragments.
+        'NOTE':[ # Note
+            {'name':'note','type':'string'}], #Free text note.
+    }
+    #checks of a whole record, run after its fields are parsed
+    record_checks={'TSEQ':_checkPrimers,'PFLP':_checkPrimers,'RFLP':_checkPrimers}
+    #compiled once, so parsing a line only dispatches on its type
+    _record_parsers=_compileRecordParsers(record_fields,record_checks)
+    _type_classes=dict([(t,'mutation') for t in mutation_types]+[(t,'evidence') for t in evidence_types]+[(t,'validation') for t in validation_types])
+
     def __init__(self,file_handle=None, ignore_errors=False):
         """
         Constructor that populates the metadata and data properties from file_handle if given,
@@ -89,44 +346,93 @@ class GDParser():
         If ignore_errors is set to True, a parsing error will only cause the current line to
         be discarded, not the entire file.
         """
+        for line_num,item_class,item_id,new_data in self._iterLines(file_handle,ignore_errors=ignore_errors):
+            self.id2line_num[item_id]=line_num
+            self.data[item_class][item_id]=new_data
+        try:
+            pass
+            self._qcChecks()
+        except GDFieldError as gdfe:
+            print("QC Check failed:")
+            
+        except GDParseError as gdpe:
+            print("QC Check failed:")
+
+    def iterRecords(self,file_handle,classes=None,types=None,ignore_errors=False):
+        """
+        Reads a GenomeDiff format file line by line from a file_handle or other iterable, and yields an
+        (item class, item ID, item) tuple for each data entry as soon as it is parsed, where item is the
+        dictionary of key:value pairs that populateFromFile stores in the data property. Neither the file
+        nor the items are kept, so a file of any size is read in constant memory. Metadata is still
+        stored in the metadata property.
+        
+        classes: only parse the entries of these item classes (mutation, evidence, validation)
+        types: only parse the entries of these types (SNP, RA, ...)
+            The lines of other entries are skipped before any of their fields are converted.
+        
+        If ignore_errors is set to True, a parsing error will only cause the current line to
+        be discarded, not the entire file.
+        """
+        for line_num,item_class,item_id,new_data in self._iterLines(file_handle,classes,types,ignore_errors):
+            yield item_class,item_id,new_data
+
+    def _keepTypes(self,classes=None,types=None):
+        """
+        Returns the set of entry types to parse for the classes and types filters of iterRecords,
+        or None to parse all of them.
+        """
+        if classes is None and types is None:
+            return None
+        keep_types=set(self.valid_types)
+        if classes is not None:
+            for item_class in classes:
+                if item_class not in self.data:
+                    raise ValueError("Unknown item class {}".format(item_class))
+            keep_types&=set([t for t in self.valid_types if self._type_classes[t] in classes])
+        if types is not None:
+            keep_types&=set(types)
+        return keep_types
+
+    def _iterLines(self,file_handle,classes=None,types=None,ignore_errors=False):
+        """
+        Generator behind iterRecords, which also yields the line number of each entry.
+        """
+        keep_types=self._keepTypes(classes,types)
+        file_handle=iter(file_handle)
         #read version info
-        ver_line=file_handle.readline()
+        ver_line=next(file_handle,'')
         if ver_line[:13] != '#=GENOME_DIFF':
             print("Invalid GenomeDiff file, header missing or malformed.")
-        else:
-            self._parseLine(1,ver_line) #process the ver_line to store the version info
-            for line_num,line in enumerate(file_handle.readlines()):
-                try:
-                    self._parseLine(line_num,line)
-                except GDFieldError as gdfe:
-                    print("Parse error in field {}:{}, could not parse {}:".format(gdfe.field_num,gdfe.field_name,gdfe.field_value))
-                    print("Message: {}".format(gdfe.msg))
-                    if gdfe.inner_exception_msg:
-                        print("Exception: {}".format(gdfe.inner_exception_msg))
-                    if not ignore_errors:
-                        raise    
-                        break
-                except GDParseError as gdpe:
-                    print("There is an error in line {} of the GenomeDiff file.".format(line_num+1))
-                    print("Error returned: {}".format(gdpe.msg))
-                    if gdpe.inner_exception_msg:
-                        print("Exception: {}".format(gdpe.inner_exception_msg))
-                    if not ignore_errors:
-                        raise    
-                        break
-                except Exception as ex:
-                    print("Unhandled exception on line {}:".format(line_num))
-                    print(ex.message)
-                    raise
-                    break
+            return
+        self._parseLine(1,ver_line) #process the ver_line to store the version info
+        for line_num,line in enumerate(file_handle):
+            #filter on the type token before anything is converted, but keep the metadata
+            if keep_types is not None and line[:2]!='#=' and line.split('\t',1)[0] not in keep_types:
+                continue
             try:
-                pass
-                self._qcChecks()
+                record=self._parseLine(line_num,line)
             except GDFieldError as gdfe:
-                print("QC Check failed:")
-                
+                print("Parse error in field {}:{}, could not parse {}:".format(gdfe.field_num,gdfe.field_name,gdfe.field_value))
+                print("Message: {}".format(gdfe.msg))
+                if gdfe.inner_exception_msg:
+                    print("Exception: {}".format(gdfe.inner_exception_msg))
+                if not ignore_errors:
+                    raise    
+                continue
             except GDParseError as gdpe:
-                print("QC Check failed:")
+                print("There is an error in line {} of the GenomeDiff file.".format(line_num+1))
+                print("Error returned: {}".format(gdpe.msg))
+                if gdpe.inner_exception_msg:
+                    print("Exception: {}".format(gdpe.inner_exception_msg))
+                if not ignore_errors:
+                    raise    
+                continue
+            except Exception as ex:
+                print("Unhandled exception on line {}:".format(line_num))
+                print(ex)
+                raise
+            if record is not None:
+                yield (line_num,)+record
 
     def _qcChecks(self):
         """
@@ -139,86 +445,12 @@ class GDParser():
                 if ev not in self.data['evidence'] and ev != 'manual':
                     raise GDFieldError(3,'parent_ids',item['parent_ids'],"Error on line {}, invalid parent id: {}".format(self.id2line_num[item],ev))
                         
-    def _parseTypeSpecificFields(self,source_data,target_data,field_defs,start_field=3):
-        """
-        Parses a set of defined fields from a row of elements and updates a dictionary of named data elements.
-        
-        Returns the next field index after the processed ones. 
-        
-        Parameters:
-            source_data: a list of raw data elements
-            target_data: reference to a dictionary which will be populated with fields from source_data
-            field_defs: a list of dictionaries defining the fields.
-                Required sub-fields:
-                    name:    any valid string
-                    type:    int, float, char, string, int_tuple
-                Optional sub-fields:
-                    allowed_values:    list that contains the values allowed in the field
-                Optional sub-fields for string fields:
-                    max_length:    integer describing the maximum allowed length.
-                Optional sub-fields for numeric fields:
-                    min_value:    number describing the maximum value allowed for a numeric field.
-                    max_value:    number describing the minimum value allowed for a numeric field.
-                    max_abs:    number describing the maximum absolute value allowed for a numeric field.
-                    min_abs:    number describing the minimum absolute value allowed for a numeric field.                
-            start_field (optional): index of the first element in source_data to process (defaults to 3)
-        """
-        if len(source_data) < len(field_defs) + start_field: #Check that we have enough fields to work with
-            raise GDParseError("Premature line termination, needed at least {} fields, only got {}".format(len(field_defs) + start_field, len(source_data)))
-        for field_idx,field in enumerate(source_data[start_field:start_field+len(field_defs)]):
-            #Switch block for field type:
-            if field_defs[field_idx]['type']=='string':
-                try:
-                    parsed_value=str(field)
-                except ValueError as ve:
-                    raise GDFieldError(field_idx+start_field,field_defs[field_idx]['name'],field,"Cannot convert to string",ve.message)
-                if 'max_length' in field_defs[field_idx] and len(parsed_field) > field_defs[field_idx]['max_length']:
-                    raise GDFieldError(field_idx+start_field,field_defs[field_idx]['name'],field,"Length of string field {} exceeds max length of {}".format(len(parsed_field),field_defs[field_idx]['max_length']))         
-            elif field_defs[field_idx]['type']=='char':
-                try:
-                    parsed_value=str(field)
-                except ValueError as ve:
-                    raise GDFieldError(field_idx+start_field,field_defs[field_idx]['name'],field,"Cannot convert to char",ve.message)
-                if len(field)>1:
-                     raise GDFieldError(field_idx+start_field,field_defs[field_idx]['name'],field,"Char field must have length 1")
-            elif field_defs[field_idx]['type'] in ('int','float'): #group numeric fields into their own subgroup that can potentially have min/max checking         
-                if field_defs[field_idx]['type']=='int':
-                    try:
-                        parsed_value=int(field)
-                    except ValueError as ve:
-                        raise GDFieldError(field_idx+start_field,field_defs[field_idx]['name'],field,"Cannot convert to integer",ve.message)
-                elif field_defs[field_idx]['type']=='float':
-                    try:
-                        parsed_value=float(field)
-                    except ValueError as ve:
-                        raise GDFieldError(field_idx+start_field,field_defs[field_idx]['name'],field,"Cannot convert to float",ve.message)
-                if 'max_value' in field_defs[field_idx] and parsed_value > field_defs[field_idx]['max_value']:
-                    raise GDFieldError(field_idx+start_field,field_defs[field_idx]['name'],field,"Value {} exceeds maximum allowable value of {}".format(parsed_value,field_defs[field_idx]['max_value']))
-                if 'min_value' in field_defs[field_idx] and parsed_value > field_defs[field_idx]['min_value']:
-                    raise GDFieldError(field_idx+start_field,field_defs[field_idx]['name'],field,"Value {} below minimum allowable value of {}".format(parsed_value,field_defs[field_idx]['min_value']))
-                if 'max_abs' in field_defs[field_idx] and parsed_value > field_defs[field_idx]['max_abs']:
-                    raise GDFieldError(field_idx+start_field,field_defs[field_idx]['name'],field,"Value {} exceeds maximum allowable absolute value of {}".format(parsed_value,field_defs[field_idx]['max_abs']))
-                if 'min_abs' in field_defs[field_idx] and parsed_value > field_defs[field_idx]['min_abs']:
-                    raise GDFieldError(field_idx+start_field,field_defs[field_idx]['name'],field,"Value {} below minimum allowable absolute value of {}".format(parsed_value,field_defs[field_idx]['min_abs']))
-            elif field_defs[field_idx]['type']=='int_tuple': #Will take any comma-separated list and return it as a tuple of ints. Currently only used for sequence ranges.
-                split_field=field.split(',')
-                if len(split_field)<2:
-                    raise GDFieldError(field_idx+start_field,field_defs[field_idx]['name'],field,"Expected more than {} items".format(len(split_field)))
-                try:
-                    parsed_value=tuple([int(e) for e in split_field])
-                except:
-                    raise GDFieldError(field_idx+start_field,field_defs[field_idx]['name'],field,"Cannot convert to integer",ve.message)
-            if 'allowed_values' in field_defs[field_idx] and parsed_value not in field_defs[field_idx]['allowed_values']:
-                raise GDFieldError(field_idx+start_field,field_defs[field_idx]['name'],field,"Value {} not permitted. Allowed values={}".format(parsed_value,field_defs[field_idx]['allowed_values']))
-            target_data[field_defs[field_idx]['name']]=parsed_value
-        return start_field+len(field_defs)
-         
     def _parseLine(self,line_num,line):
         """ 
         Processes each line of the file and either stores the information in the appropriate
             property dictionary (metadata, data) or does nothing (comment).
             
-        returns None
+        returns (item class, item ID, item) for a data line, and None otherwise
         """
         if line[:2]=='#=':
             #this will be a metadata line
@@ -233,33 +465,26 @@ class GDParser():
                     self.metadata[var_name] = [var_value,self.metadata[var_name]]
             else:
                 self.metadata[var_name]=var_value
-        elif re.match('[#\s]',line[0]): #comment lines begin with # or whitespace
+        elif line[0]=='#' or line[0].isspace(): #comment lines begin with # or whitespace
             #this line is a comment, do nothing
             pass
         else:
             #this must be a data line
-            new_data={}
-            data_elements=re.split('\t',line.strip()) #data lines are tab-delimited
+            data_elements=line.strip().split('\t') #data lines are tab-delimited
             
             #Field 1: type <string>
             #type of the entry on this line.
-            if data_elements[0] in self.mutation_types:  #test for validity of type and assign the correct class:
-                item_class='mutation'
-            elif data_elements[0] in self.evidence_types:
-                item_class='evidence'
-            elif data_elements[0] in self.validation_types:
-                item_class='validation'
-            else:
+            item_class=self._type_classes.get(data_elements[0]) #test for validity of type and assign the correct class
+            if item_class is None:
                 raise GDFieldError(1,'type',data_elements[0],"Invalid entry type")
-            new_data['type']=data_elements[0] 
+            new_data={'type':data_elements[0]}
             
             #Field 2: id or evidence-id <uint32>
             #For evidence and validation lines, the id of this item. For mutation lines, the ids of all evidence or validation items that support this mutation. May be set to "." if a line was manually edited.
             try:
                 item_id=int(data_elements[1])
-                self.id2line_num[item_id]=line_num
             except ValueError as ve: #check that it's an integer:
-                raise GDFieldError(2,'id',data_elements[1],"Cannot convert to integer",ve.message)
+                raise GDFieldError(2,'id',data_elements[1],"Cannot convert to integer",str(ve))
             
             #Field 3: parent-ids <uint32>
             #ids of evidence that support this mutation. May be set to "." or left blank.
@@ -271,8 +496,8 @@ class GDParser():
                         try:
                         #store the evidence ids as a list of ints  -- later check that they are valid once all the ids are loaded
                             new_data['parent_ids'] = [int(element) for element in data_elements[2].split(',')]
-                        except ValueError:
-                            raise GDFieldError(2,'parent_ids',data_elements[2],"Cannot convert an element of parent_ids to integer",ve.message)
+                        except ValueError as ve:
+                            raise GDFieldError(2,'parent_ids',data_elements[2],"Cannot convert an element of parent_ids to integer",str(ve))
                 else:
                     #we have a non-blank evidence field for something that isn't a mutation. Not good.
                     raise GDFieldError(3,'parent_ids',data_elements[2],"Parent ID references only valid for mutation entries")
@@ -280,322 +505,10 @@ class GDParser():
             #===============================================================
             # Content and length of next set of fields varies by class and type 
             #===============================================================
-            
-            #construct a list of field definitions to pass to a sub-parser
-            field_list=[]
-            
-            if new_data['type']=='SNP': # Base substitution mutation
-                #Field 4: seq_id <string>
-                #id of reference sequence fragment containing mutation, evidence, or validation.
-                field_list.append({'name':'seq_id','type':'string'})
-                #Field 5: position <uint32>
-                #position in reference sequence fragment.
-                field_list.append({'name':'position','type':'int'})
-                #Field 6: new_seq <char>
-                #new base at position
-                field_list.append({'name':'new_seq','type':'char'})
-                #------------------------------------------------------------------------------ 
-                next_field=self._parseTypeSpecificFields(data_elements, new_data, field_list,3)
-                #------------------------------------------------------------------------------ 
-            elif new_data['type']=='SUB': # Multiple base substitution mutation
-                #Field 4: seq_id <string>
-                #id of reference sequence fragment containing mutation, evidence, or validation.
-                field_list.append({'name':'seq_id','type':'string'})
-                #Field 5: position <uint32>
-                #position of the first replaced nucleotide in reference sequence fragment.
-                field_list.append({'name':'position','type':'int'})
-                #Field 6: size <uint32>
-                #number of bases after the specified reference position to replace with new_seq
-                field_list.append({'name':'size','type':'int'})
-                #Field 7: new_seq <string>
-                #new bases at position
-                field_list.append({'name':'new_seq','type':'string'})
-                #------------------------------------------------------------------------------ 
-                next_field=self._parseTypeSpecificFields(data_elements, new_data, field_list,  3)
-                #------------------------------------------------------------------------------ 
-            elif new_data['type']=='DEL': # Deletion mutation
-                #Field 4: seq_id <string> 
-                #id of reference sequence fragment containing mutation, evidence, or validation.
-                field_list.append({'name':'seq_id','type':'string'})
-                #Field 5: position <uint32>
-                #position in reference sequence fragment.
-                field_list.append({'name':'position','type':'int'})                      
-                #Field 6: size <uint32>
-                #number of bases deleted in reference, including reference position.
-                field_list.append({'name':'size','type':'int'})
-                #------------------------------------------------------------------------------ 
-                next_field=self._parseTypeSpecificFields(data_elements, new_data, field_list,  3)
-                #------------------------------------------------------------------------------ 
-            elif new_data['type']=='INS': # Insertion mutation
-                #Field 4: seq_id <string>
-                #id of reference sequence fragment containing mutation, evidence, or validation.
-                field_list.append({'name':'seq_id','type':'string'})
-                #Field 5: position <uint32>
-                #position in reference sequence fragment, after which the INS is placed.
-                field_list.append({'name':'position','type':'int'})     
-                #Field 6: new_seq <string>
-                #new bases inserted after the specified reference position
-                field_list.append({'name':'new_seq','type':'string'})     
-                #------------------------------------------------------------------------------ 
-                next_field=self._parseTypeSpecificFields(data_elements, new_data, field_list,  3)
-                #------------------------------------------------------------------------------ 
-            elif new_data['type']=='MOB': # Mobile element insertion mutation
-                #Field 4: seq_id <string>
-                #id of reference sequence fragment containing mutation, evidence, or validation.
-                field_list.append({'name':'seq_id','type':'string'})
-                #Field 5: position <uint32>
-                #position in reference sequence fragment.
-                field_list.append({'name':'position','type':'int'})
-                #Field 6: repeat_name <string>
-                #name of the mobile element. Should correspond to an annotated repeat_region in the reference.
-                field_list.append({'name':'repeat_name','type':'string'})
-                #Field 7: strand <1/-1>
-                #strand of mobile element insertion.
-                field_list.append({'name':'strand','type':'int','allowable_values':[-1,1]})
-                #Field 8: duplication_size <uint32>
-                #number of bases duplicated during insertion, beginning with the specified reference position.
-                field_list.append({'name':'duplication_size','type':'int'})
-                #------------------------------------------------------------------------------ 
-                next_field=self._parseTypeSpecificFields(data_elements, new_data, field_list,  3)
-                #------------------------------------------------------------------------------ 
-            elif new_data['type']=='AMP': # Amplification Mutation
-                #Field 4: seq_id <string>
-                #id of reference sequence fragment containing mutation, evidence, or validation.
-                field_list.append({'name':'seq_id','type':'string'})
-                #Field 5: position <uint32>
-                #position in reference sequence fragment.
-                field_list.append({'name':'position','type':'int'})
-                #Field 6: size <uint32>
-                #number of bases duplicated starting with the specified reference position.
-                field_list.append({'name':'size','type':'int'})
-                #Field 7: new_copy_number <uint32>
-                #new number of copies of specified bases.
-                field_list.append({'name':'new_copy_number','type':'int'})
-                #------------------------------------------------------------------------------ 
-                next_field=self._parseTypeSpecificFields(data_elements, new_data, field_list,  3)
-                #------------------------------------------------------------------------------ 
-            elif new_data['type']=='CON': # Gene conversion mutation
-                #Field 4: seq_id <string>
-                #id of reference sequence fragment containing mutation, evidence, or validation.
-                field_list.append({'name':'seq_id','type':'string'})
-                #Field 5: position <uint32>
-                #position in reference sequence fragment that was the target of gene conversion from another genomic location.
-                field_list.append({'name':'position','type':'int'})
-                #Field 6: size <uint32>
-                #number of bases to replace in the reference genome beginning at the specified position.
-                field_list.append({'name':'size','type':'int'})
-                #Field 7: region <sequence:start-end>
-                #region in the reference genome to use as a replacement.
-                field_list.append({'name':'region','type':'int_tuple'})
-                #------------------------------------------------------------------------------ 
-                next_field=self._parseTypeSpecificFields(data_elements, new_data, field_list,  3)
-                #------------------------------------------------------------------------------ 
-            elif new_data['type']=='INV': #Inversion mutation
-                #Field 4: seq_id <string>
-                #id of reference sequence fragment containing mutation, evidence, or validation.
-                field_list.append({'name':'seq_id','type':'string'})
-                #Field 5: position <uint32>
-                #position in reference sequence fragment.
-                field_list.append({'name':'position','type':'int'})
-                #Field 6: size <uint32>
-                #number of bases in inverted region beginning at the specified reference position.
-                field_list.append({'name':'size','type':'int'})
-                #------------------------------------------------------------------------------ 
-                next_field=self._parseTypeSpecificFields(data_elements, new_data, field_list,  3)
-                #------------------------------------------------------------------------------ 
-            elif new_data['type']=='RA': # Read alignment evidence
-                #Field 4: seq_id <string>
-                #id of reference sequence fragment containing mutation, evidence, or validation.
-                field_list.append({'name':'seq_id','type':'string'})
-                #Field 5: position <uint32>
-                #position in reference sequence fragment.
-                field_list.append({'name':'position','type':'int'})
-                #Field 6: insert_position <uint32>
-                #number of bases inserted after the reference position to get to this base. An value of zero refers to the base. A value of 5 means that this evidence if for the fifth newly inserted column after the reference position.
-                field_list.append({'name':'insert_position','type':'int'})
-                #Field 7: ref_base <char>
-                #base in the reference genome.
-                field_list.append({'name':'ref_base','type':'char'})
-                #Field 8: new_base <char>
-                #new base supported by read alignment evidence.
-                field_list.append({'name':'new_base','type':'char'})
-                #------------------------------------------------------------------------------ 
-                next_field=self._parseTypeSpecificFields(data_elements, new_data, field_list,  3)
-                #------------------------------------------------------------------------------ 
-            elif new_data['type']=='MC': # Missing coverage evidence
-                #Field 4: seq_id <string>
-                #id of reference sequence fragment containing mutation, evidence, or validation.
-                field_list.append({'name':'seq_id','type':'string'})
-                #Field 5: start <uint32>
-                #start position in reference sequence fragment.
-                field_list.append({'name':'start','type':'int'})
-                #Field 6: end <uint32>
-                #end position in reference sequence of region.
-                field_list.append({'name':'end','type':'int'})
-                #Field 7: start_range <uint32>
-                #number of bases to offset after the start position to define the upper limit of the range where the start of a deletion could be.
-                field_list.append({'name':'start_range','type':'int'})
-                #Field 8: end_range <uint32>
-                #number of bases to offset before the end position to define the lower limit of the range where the start of a deletion could be.
-                field_list.append({'name':'end_range','type':'int'})
-                #------------------------------------------------------------------------------ 
-                next_field=self._parseTypeSpecificFields(data_elements, new_data, field_list,  3)
-                #------------------------------------------------------------------------------ 
-            elif new_data['type']=='JC': # New junction evidence
-                #Field 4: side_1_seq_id <string>
-                #id of reference sequence fragment containing side 1 of the junction.
-                field_list.append({'name':'side_1_seq_id','type':'string'})
-                #Field 5: side_1_position <uint32>
-                #position of side 1 at the junction boundary.
-                field_list.append({'name':'side_1_position','type':'int'})
-                #Field 6: side_1_strand <1/-1>
-                #direction that side 1 continues matching the reference sequence
-                field_list.append({'name':'side_1_strand','type':'int','allowable_values':[-1,1]})
-                #Field 7: side_2_seq_id <string>
-                #id of reference sequence fragment containing side 2 of the junction.
-                field_list.append({'name':'side_2_seq_id','type':'string'})
-                #Field 8: side_2_position <uint32>
-                #position of side 2 at the junction boundary.
-                field_list.append({'name':'side_2_position','type':'int'})
-                #Field 9: side_2_strand <1/-1>
-                #direction that side 2 continues matching the reference sequence
-                field_list.append({'name':'side_2_strand','type':'int','allowable_values':[-1,1]})
-                #Field 10: overlap <uint32>
-                #number of bases that the two sides of the new junction have in common.
-                field_list.append({'name':'overlap','type':'int'})
-                #------------------------------------------------------------------------------ 
-                next_field=self._parseTypeSpecificFields(data_elements, new_data, field_list,  3)
-                #------------------------------------------------------------------------------ 
-            elif new_data['type']=='UN': # Unknown base evidence
-                #Field 4: seq_id <string>
-                #id of reference sequence fragment containing mutation, evidence, or validation.
-                field_list.append({'name':'seq_id','type':'string'})
-                #Field 5: start <uint32>
-                #start position in reference sequence fragment.
-                field_list.append({'name':'start','type':'int'})
-                #Field 6: end <uint32>
-                #end position in reference sequence of region.
-                field_list.append({'name':'end','type':'int'})
-                #------------------------------------------------------------------------------ 
-                next_field=self._parseTypeSpecificFields(data_elements, new_data, field_list,  3)
-                #------------------------------------------------------------------------------ 
-            elif new_data['type']=='CURA': # True-positive curated by an expert
-                #An expert has examined the data output from a prediction program and determined that this mutations is a true positive.
-                #Field 4: expert <string>
-                #Name or initials of the person who predicted the mutation.
-                field_list.append({'name':'expert','type':'string'})
-                #------------------------------------------------------------------------------ 
-                next_field=self._parseTypeSpecificFields(data_elements, new_data, field_list,  3)
-                #------------------------------------------------------------------------------ 
-            elif new_data['type']=='FPOS': #  False-positive curated by an expert
-                #An expert has examined the raw read data and determined that this predicted mutation is a false positive.
-                #Field 4: expert <string>
-                #Name or initials of the person who predicted the mutation.
-                field_list.append({'name':'expert','type':'string'})
-                #------------------------------------------------------------------------------ 
-                next_field=self._parseTypeSpecificFields(data_elements, new_data, field_list,  3)
-                #------------------------------------------------------------------------------ 
-            elif new_data['type']=='PHYL': # Phylogenetic comparison
-                #This validation was transferred from validation in another, related genome.
-                #Field 4: gd <string>
-                #Name of the genome_diff file containing the evidence.
-                field_list.append({'name':'gd','type':'string'})
-                #------------------------------------------------------------------------------ 
-                next_field=self._parseTypeSpecificFields(data_elements, new_data, field_list,  3)
-                #------------------------------------------------------------------------------ 
-            elif new_data['type']=='TSEQ': # Targeted resequencing
-                #Field 4: seq_id <string>
-                #id of reference sequence fragment containing mutation, evidence, or validation.
-                field_list.append({'name':'seq_id','type':'string'})
-                #Field 5: primer1_start <uint32>
-                #position in reference sequence of the 5' end of primer 1.
-                field_list.append({'name':'primer1_start','type':'int'})
-                #Field 6: primer1_end <uint32>
-                #position in reference sequence of the 3' end of primer 1.
-                field_list.append({'name':'primer1_end','type':'int'})
-                #Field 7: primer2_start <uint32>
-                #position in reference sequence of the 5' end of primer 2.
-                field_list.append({'name':'primer2_start','type':'int'})
-                #Field 8: primer2_end <uint32>
-                #position in reference sequence of the 3' end of primer 2.
-                field_list.append({'name':'primer2_end','type':'int'})
-                #------------------------------------------------------------------------------ 
-                next_field=self._parseTypeSpecificFields(data_elements, new_data, field_list,  3)
-                #------------------------------------------------------------------------------ 
-                if new_data['primer1_start'] >= new_data['primer1_end']:
-                    raise GDFieldError(6,'primer1_end',new_data['primer1_end'],"Primer 1 end location {} must be > primer start location {}".format(new_data['primer1_end'],new_data['primer1_start']))
-                if new_data['primer2_start'] >= new_data['primer2_end']:
-                    raise GDFieldError(8,'primer2_end',new_data['primer2_end'],"Primer 2 end location {} must be > primer start location {}".format(new_data['primer2_end'],new_data['primer2_start']))
-            elif new_data['type']=='PFLP': #PCR-fragment length polymorphism
-                #Field 4: seq_id <string>
-                #id of reference sequence fragment containing mutation, evidence, or validation.
-                field_list.append({'name':'seq_id','type':'string'})
-                #Field 5: primer1_start <uint32>
-                #position in reference sequence of the 5' end of primer 1.
-                field_list.append({'name':'primer1_start','type':'int'})
-                #Field 6: primer1_end <uint32>
-                #position in reference sequence of the 3' end of primer 1.
-                field_list.append({'name':'primer1_end','type':'int'})
-                #Field 7: primer2_start <uint32>
-                #position in reference sequence of the 5' end of primer 2.
-                field_list.append({'name':'primer2_start','type':'int'})
-                #Field 8: primer2_end <uint32>
-                #position in reference sequence of the 3' end of primer 2.
-                field_list.append({'name':'primer2_end','type':'int'})
-                #------------------------------------------------------------------------------ 
-                next_field=self._parseTypeSpecificFields(data_elements, new_data, field_list,  3)
-                #------------------------------------------------------------------------------ 
-                if new_data['primer1_start'] >= new_data['primer1_end']:
-                    raise GDFieldError(6,'primer1_end',new_data['primer1_end'],"Primer 1 end location {} must be > primer start location {}".format(new_data['primer1_end'],new_data['primer1_start']))
-                if new_data['primer2_start'] >= new_data['primer2_end']:
-                    raise GDFieldError(8,'primer2_end',new_data['primer2_end'],"Primer 2 end location {} must be > primer start location {}".format(new_data['primer2_end'],new_data['primer2_start']))
-            elif new_data['type']=='RFLP': #Restriction fragment length polymorphism
-                #Field 4: seq_id <string>
-                #id of reference sequence fragment containing mutation, evidence, or validation.
-                field_list.append({'name':'seq_id','type':'string'})
-                #Field 5: primer1_start <uint32>
-                #position in reference sequence of the 5' end of primer 1.
-                field_list.append({'name':'primer1_start','type':'int'})
-                #Field 6: primer1_end <uint32>
-                #position in reference sequence of the 3' end of primer 1.
-                field_list.append({'name':'primer1_end','type':'int'})
-                #Field 7: primer2_start <uint32>
-                #position in reference sequence of the 5' end of primer 2.
-                new_data['primer2_start']=int(data_elements[6])
-                #Field 8: primer2_end <uint32>
-                #position in reference sequence of the 3' end of primer 2.
-                field_list.append({'name':'primer2_start','type':'int'})
-                #Field 9: enzyme <string>
-                #Restriction enzyme used to distinguish reference from mutated allele.
-                field_list.append({'name':'enzyme','type':'string'})
-                #------------------------------------------------------------------------------ 
-                next_field=self._parseTypeSpecificFields(data_elements, new_data, field_list,  3)
-                #------------------------------------------------------------------------------ 
-                if new_data['primer1_start'] >= new_data['primer1_end']:
-                    raise GDFieldError(6,'primer1_end',new_data['primer1_end'],"Primer 1 end location {} must be > primer start location {}".format(new_data['primer1_end'],new_data['primer1_start']))
-                if new_data['primer2_start'] >= new_data['primer2_end']:
-                    raise GDFieldError(8,'primer2_end',new_data['primer2_end'],"Primer 2 end location {} must be > primer start location {}".format(new_data['primer2_end'],new_data['primer2_start']))
-            elif new_data['type']=='PFGE': #Pulsed-field gel electrophoresis
-                #Changes in fragment sizes of genomic DNA digested with restriction enzymes and separated by pulsed-field
-                #Field 4: seq_id <string>
-                #id of reference sequence fragment containing mutation, evidence, or validation.
-                field_list.append({'name':'seq_id','type':'string'})
-                #Field 5: enzyme <string>
-                #Restriction enzyme used to digest genomic DNA and observe fragments.
-                field_list.append({'name':'enzyme','type':'string'})
-                #------------------------------------------------------------------------------ 
-                next_field=self._parseTypeSpecificFields(data_elements, new_data, field_list,  3)
-                #------------------------------------------------------------------------------ 
-            elif new_data['type']=='NOTE': # Note
-                #Generic container for a note about a mutation prediction
-                #Field 4: note <string>
-                #Free text note.
-                field_list.append({'name':'note','type':'string'})
-                #------------------------------------------------------------------------------ 
-                next_field=self._parseTypeSpecificFields(data_elements, new_data, field_list,  3)
-                #------------------------------------------------------------------------------ 
-            else:
-                raise GDFieldError(1,'type',data_elements[0],"Invalid entry type")
+            fields,record_check=self._record_parsers[new_data['type']]
+            next_field=_parseFields(data_elements, new_data, fields, 3)
+            if record_check is not None:
+                record_check(new_data)
                         
             #=================================================
             # Process any optional key=value pairs
@@ -604,7 +517,16 @@ class GDParser():
                 splitfield=data_elements[field_idx].split('=')
                 if len(splitfield)>1:
                     key=splitfield[0].strip()
-                    value=smartconvert(splitfield[1].strip())
+                    value=smartconvert(splitfield[1],key)
                     new_data[key]=value
-            #Insert the dictionary for the new item into the class data dictionary, keyed by id.
-            self.data[item_class][item_id]=new_data
\ No newline at end of file
+            return item_class,item_id,new_data
+
+def iter_records(file_handle,classes=None,types=None,ignore_errors=False):
+    """
+    Yields an (item class, item ID, item) tuple for each data entry of a GenomeDiff file, one at a time.
+    See GDParser.iterRecords, which also keeps the metadata.
+    
+    For example, to count the SNPs of a file without holding it in memory:
+        n_snps=sum(1 for record in iter_records(open('output.gd'),types=['SNP']))
+    """
+    return GDParser().iterRecords(file_handle,classes,types,ignore_errors)
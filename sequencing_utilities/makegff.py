@@ -1,17 +1,375 @@
 #!/usr/bin/env python
 # PYTHON_ARGCOMPLETE_OK
-from os.path import split
-from math import log
+from os import rename, remove
+from os.path import split, getsize, isfile
 from warnings import warn
+from multiprocessing import Pool
+from contextlib import contextmanager
+from time import time, process_time
 
-from numpy import zeros, roll
+from numpy import zeros, empty, full, unique, array, concatenate, cumsum, \
+    add, subtract, where, minimum, maximum, iinfo, errstate, int64, uint8, \
+    uint16, uint32, uint64, float64, log2 as numpy_log2
 
 try:
     import pysam
 except ImportError as e:
     print(e);
 
-def count_coverage(samfile, flip=False, include_insert=False):
+from .coverage_store import write_coverage_store, parse_region
+from .coverage_cache import CoverageCache
+
+class CoverageCounter(object):
+    """counts per base coverage of several tracks using a difference array
+
+    Every interval only adds +1 at its start and -1 at its end. Intervals
+    are buffered and applied with a vectorized scatter-add once batch_size
+    of them have been collected, and coverage is recovered with a
+    cumulative sum, so the cost of an interval does not depend on its
+    length.
+
+    The bounds of an interval follow python slice semantics on an array of
+    the track length, so add(track, start, end) counts exactly the bases
+    which track_array[start:end] += 1 would.
+
+    lengths: The length of each track.
+
+    dtype: The type used to store counts. Unsigned integer types work as
+    long as no base has more coverage than the type can hold.
+
+    batch_size: The number of intervals to buffer before they are applied.
+    """
+
+    def __init__(self, lengths, dtype=int64, batch_size=100000):
+        self.lengths = array(lengths, dtype=int64)
+        # each track gets one extra slot in front of it, which lets
+        # coverage() return a shifted view instead of a rolled copy
+        self.offsets = zeros((len(self.lengths) + 1,), dtype=int64)
+        cumsum(self.lengths + 1, out=self.offsets[1:])
+        self.deltas = zeros((self.offsets[-1],), dtype=dtype)
+        self.finished = zeros((len(self.lengths),), dtype=bool)
+        self.batch_size = batch_size
+        self.n_intervals = 0
+        self.timer = None
+        self._tracks = []
+        self._starts = []
+        self._ends = []
+
+    def add(self, track, start, end):
+        """count the interval [start, end) on a track"""
+        if end is None:
+            end = self.lengths[track]
+        self._tracks.append(track)
+        self._starts.append(start)
+        self._ends.append(end)
+        if len(self._tracks) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """apply all buffered intervals to the difference array"""
+        if len(self._tracks) == 0:
+            return
+        with _timed(self.timer, "flush"):
+            self._flush()
+
+    def _flush(self):
+        tracks = array(self._tracks, dtype=int64)
+        self.n_intervals += len(tracks)
+        self._tracks = []
+        if self.finished[tracks].any():
+            raise ValueError("can not add to a track after its coverage "
+                             "has been computed")
+        lengths = self.lengths[tracks]
+        starts = _slice_bounds(array(self._starts, dtype=int64), lengths)
+        ends = _slice_bounds(array(self._ends, dtype=int64), lengths)
+        self._starts = []
+        self._ends = []
+        keep = ends > starts
+        # the delta for position i of a track is stored at offset + 1 + i
+        offsets = self.offsets[tracks] + 1
+        add.at(self.deltas, (offsets + starts)[keep], 1)
+        # intervals running to the end of the track need no -1
+        keep &= ends < lengths
+        subtract.at(self.deltas, (offsets + ends)[keep], 1)
+
+    def coverage(self, track, shift=True):
+        """returns the per base coverage of a track shifted by one base
+
+        Index i of the returned array holds the coverage at position i - 1,
+        and index 0 wraps around to the last position, which is the same as
+        numpy.roll(coverage, 1). The cumulative sum is computed in place and
+        a view is returned, so no copy of the track is made. Nothing can be
+        added to a track after its coverage has been computed.
+
+        shift: If False, index i holds the coverage at position i instead.
+        """
+        self.flush()
+        offset = self.offsets[track]
+        length = self.lengths[track]
+        if not self.finished[track]:
+            deltas = self.deltas[offset + 1:offset + 1 + length]
+            cumsum(deltas, dtype=self.deltas.dtype, out=deltas)
+            self.deltas[offset] = self.deltas[offset + length]
+            self.finished[track] = True
+        if not shift:
+            return self.deltas[offset + 1:offset + 1 + length]
+        return self.deltas[offset:offset + length]
+
+    def compact(self, track):
+        """returns (start, deltas) for the part of a track with any counts
+
+        This is much smaller than the full track when only a region was
+        counted, which makes it cheap to send between processes.
+        """
+        self.flush()
+        offset = self.offsets[track]
+        deltas = self.deltas[offset:self.offsets[track + 1]]
+        nonzero = deltas.nonzero()[0]
+        if len(nonzero) == 0:
+            return 0, deltas[:0].copy()
+        return nonzero[0], deltas[nonzero[0]:nonzero[-1] + 1].copy()
+
+    def merge(self, track, start, deltas):
+        """add the deltas from compact() of another counter to a track"""
+        offset = self.offsets[track] + start
+        self.deltas[offset:offset + len(deltas)] += deltas
+
+
+class PhaseTimer(object):
+    """records the wall and cpu time of the phases of a run, and counters
+    such as the number of reads processed
+
+    Pass one as the timer of write_samfile_to_gff to find where the time of
+    a slow conversion goes. The phases of counting in a single process are
+    "open" (reading the header), "read" (decompressing and walking the
+    reads, which includes "flush"), "flush" (applying buffered intervals to
+    the counts), "cumsum" (turning the differences into coverage) and
+    "write" (formatting and writing the output). Other ways of counting
+    are timed as a single "count" phase, without read counters.
+
+    callback: Called with the record from finish().
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.phases = {}
+        self.counters = {}
+        self.info = {}
+        self._start = time()
+        self._start_cpu = process_time()
+
+    @contextmanager
+    def phase(self, name):
+        """time the body of a with statement as the phase name. Repeated
+        phases add up."""
+        start, start_cpu = time(), process_time()
+        try:
+            yield
+        finally:
+            times = self.phases.setdefault(name, {"wall_seconds": 0.,
+                                                  "cpu_seconds": 0.})
+            times["wall_seconds"] += time() - start
+            times["cpu_seconds"] += process_time() - start_cpu
+
+    def count(self, name, n=1):
+        """add n to the counter name"""
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def record(self):
+        """returns a json serializable dict of the phases and counters"""
+        record = dict(self.info)
+        record.update(self.counters)
+        record["phases"] = self.phases
+        record["wall_seconds"] = time() - self._start
+        record["cpu_seconds"] = process_time() - self._start_cpu
+        return record
+
+    def finish(self):
+        """returns record(), after passing it to the callback"""
+        record = self.record()
+        if self.callback is not None:
+            self.callback(record)
+        return record
+
+
+@contextmanager
+def _timed(timer, name):
+    """time a phase with timer, if there is one"""
+    if timer is None:
+        yield
+    else:
+        with timer.phase(name):
+            yield
+
+
+def _slice_bounds(indices, lengths):
+    """resolve slice indices against array lengths like python does"""
+    indices = where(indices < 0, indices + lengths, indices)
+    return minimum(maximum(indices, 0), lengths)
+
+
+def _counter_dtype(samfile, dtype):
+    """resolve the "auto" dtype to the smallest unsigned integer type which
+    can hold the coverage of any base in the samfile"""
+    if not (isinstance(dtype, str) and dtype == "auto"):
+        return dtype
+    try:
+        # no base can be covered by more reads than were mapped
+        n_mapped = samfile.mapped
+    except (ValueError, AttributeError):
+        # without an index the number of mapped reads is unknown
+        return uint32
+    for candidate in (uint16, uint32):
+        if n_mapped < iinfo(candidate).max:
+            return candidate
+    return uint64
+
+
+def _new_counter(samfile, dtype=float64):
+    """create a CoverageCounter with two strand tracks per reference
+
+    The plus strand of reference i is track 2 * i, and the minus strand is
+    track 2 * i + 1.
+    """
+    lengths = []
+    for length in samfile.lengths:
+        # matches the gff coordinates after the shift, extra 0's never hurt
+        lengths.extend([length + 2, length + 2])
+    return CoverageCounter(lengths, dtype=dtype)
+
+
+def _add_read(counter, read, include_insert=False):
+    """add the coverage of one mapped read to the counter"""
+    # for paired and data get entire insert only from read 1
+    if include_insert and read.is_proper_pair:
+        if read.is_read2:
+            return  # will get handled with read 1
+        if read.is_reverse:
+            counter.add(2 * read.tid + 1, read.pnext, read.aend)
+        else:
+            counter.add(2 * read.tid, read.pos, read.pos + read.isize)
+    else:
+        # Truth table for where reads are mapped
+        # read2 is flipped
+
+        # is_read1  is_reverse      outcome
+        # ---------------------------------
+        # True      False           +
+        # True      True            -
+        # False     False           -
+        # False     True            +
+
+        # therefore read1 == is_reverse --> negative
+        #           read1 != is_reverse --> positive
+
+        # If unpaired, read.is_read1 will be False,
+        # so we need a separate variable.
+        is_read1 = not read.is_paired or read.is_read1
+        if read.is_reverse == is_read1:
+            counter.add(2 * read.tid + 1, read.pos, read.aend)
+        else:
+            counter.add(2 * read.tid, read.pos, read.aend)
+
+
+def _add_read_5prime(counter, read):
+    """add the 5' end of one mapped read to the counter"""
+    if read.is_reverse:
+        counter.add(2 * read.tid + 1, read.aend - 1, read.aend)
+    else:
+        counter.add(2 * read.tid, read.pos, read.pos + 1)
+
+
+def _add_read_3prime(counter, read):
+    """add the 3' end of one mapped read to the counter"""
+    if read.is_reverse:
+        counter.add(2 * read.tid + 1, read.pos, read.pos + 1)
+    else:
+        counter.add(2 * read.tid, read.aend - 1, read.aend)
+
+
+def _count_reads(reads, counter, include_insert=False):
+    """add the coverage of each mapped read to the counter"""
+    for read in reads:
+        if read.is_unmapped:
+            continue
+        _add_read(counter, read, include_insert)
+
+
+def _count_reads_5prime(reads, counter):
+    """add the 5' end of each mapped read to the counter"""
+    for read in reads:
+        if read.is_read2:
+            warn("5' only data should not have been processed as Paired-end.")
+            continue
+        if read.is_unmapped:
+            continue
+        _add_read_5prime(counter, read)
+
+
+def _tally_reads(reads, counters):
+    """yield reads, adding how many there were and how many were unmapped
+    to the "reads" and "reads_unmapped" of a dict of counters"""
+    n_reads = 0
+    n_unmapped = 0
+    try:
+        for read in reads:
+            n_reads += 1
+            if read.is_unmapped:
+                n_unmapped += 1
+            yield read
+    finally:
+        counters["reads"] = counters.get("reads", 0) + n_reads
+        counters["reads_unmapped"] = counters.get("reads_unmapped", 0) + \
+            n_unmapped
+
+
+def _count_with_timer(samfile, reads, counter, count_func, timer, flip,
+                      **kwargs):
+    """count reads into counter with count_func, timing the phases"""
+    if timer is not None:
+        reads = _tally_reads(reads, timer.counters)
+        counter.timer = timer
+    with _timed(timer, "read"):
+        count_func(reads, counter, **kwargs)
+    with _timed(timer, "cumsum"):
+        all_counts = _collect_counts(samfile.references, counter, flip=flip)
+    if timer is not None:
+        timer.count("reads_counted", counter.n_intervals)
+        # reads which were mapped but not counted on their own, such as
+        # read 2 with include_insert or five_prime
+        timer.count("reads_skipped",
+            timer.counters["reads"] - timer.counters["reads_unmapped"]
+            - counter.n_intervals)
+    return all_counts
+
+
+def _tee_reads(reads, outfile):
+    """yield each read after writing it to outfile"""
+    for read in reads:
+        outfile.write(read)
+        yield read
+
+
+def _collect_counts(references, counter, flip=False):
+    """store the counted strands per reference"""
+    all_counts = {}
+    for i, reference in enumerate(references):
+        all_counts[reference] = {}
+        # coverage is shifted by 1, so the first base position (at index 0)
+        # is now at index 1
+        plus_strand = counter.coverage(2 * i)
+        minus_strand = counter.coverage(2 * i + 1)
+        if flip:
+            all_counts[reference]["-"] = plus_strand
+            all_counts[reference]["+"] = minus_strand
+        else:
+            all_counts[reference]["+"] = plus_strand
+            all_counts[reference]["-"] = minus_strand
+    return all_counts
+
+
+def count_coverage(samfile, flip=False, include_insert=False, dtype=float64,
+        bin_size=None, bin_method="mean", reads=None, timer=None):
     """counts coverage per base in a strand-specific manner
 
     include_insert: If the insert between paired end reads should be
@@ -19,112 +377,855 @@ def count_coverage(samfile, flip=False, include_insert=False):
 
     flip: Whether or not the strands should be flipped.
     This should be true for RNA-seq, and false for ChIP-exo
+
+    dtype: The type of the count arrays. "auto" picks the smallest unsigned
+    integer type which can hold the counts, which takes a fraction of the
+    memory of the default float64.
+
+    bin_size: If given, the counts are aggregated into bins of this many
+    bases with bin_method ("mean", "sum" or "max"), and index k of the
+    arrays holds bases k * bin_size + 1 to (k + 1) * bin_size.
+
+    reads: The reads to count, if not all reads in samfile. samfile then
+    only provides the references.
+
+    timer: A PhaseTimer to record the time of each phase in.
 """
 
-    all_counts = {}
-    plus_strands = []
-    minus_strands = []
-    chromosome_sizes = dict(list(zip(samfile.references, samfile.lengths)))
-    for i in chromosome_sizes:
-        chromosome_sizes[i] += 2  # allows to roll later, extra 0's never hurt
-    for reference in samfile.references:  # create an array for each reference
-        plus_strands.append(zeros((chromosome_sizes[reference],)))
-        minus_strands.append(zeros((chromosome_sizes[reference],)))
-    # iterate through each mapped read
-    for i, read in enumerate(samfile):
-        if read.is_unmapped:
-            continue
-        # for paired and data get entire insert only from read 1
-        if include_insert and read.is_proper_pair:
-            if read.is_read2:
-                continue  # will get handled with read 1
-            if read.is_reverse:
-                minus_strands[read.tid][read.pnext:read.aend] += 1
-            else:
-                plus_strands[read.tid][read.pos:read.pos + read.isize] += 1
-        else:
-            # Truth table for where reads are mapped
-            # read2 is flipped
-
-            # is_read1  is_reverse      outcome
-            # ---------------------------------
-            # True      False           +
-            # True      True            -
-            # False     False           -
-            # False     True            +
-
-            # therefore read1 == is_reverse --> negative
-            #           read1 != is_reverse --> positive
-
-            # If unpaired, read.is_read1 will be False,
-            # so we need a separate variable.
-            is_read1 = not read.is_paired or read.is_read1
-            if read.is_reverse == is_read1:
-                minus_strands[read.tid][read.pos:read.aend] += 1
-            else:
-                plus_strands[read.tid][read.pos:read.aend] += 1
-    # store the results per reference
-    for i, reference in enumerate(samfile.references):
-        all_counts[reference] = {}
-        # roll shifts by 1, so the first base position (at index 0) is now at
-        # index 1
-        if flip:
-            all_counts[reference]["-"] = roll(plus_strands[i], 1)
-            all_counts[reference]["+"] = roll(minus_strands[i], 1)
-        else:
-            all_counts[reference]["+"] = roll(plus_strands[i], 1)
-            all_counts[reference]["-"] = roll(minus_strands[i], 1)
+    counter = _new_counter(samfile, _counter_dtype(samfile, dtype))
+    all_counts = _count_with_timer(samfile,
+        samfile if reads is None else reads, counter, _count_reads, timer,
+        flip, include_insert=include_insert)
+    if bin_size:
+        return _bin_all_counts(all_counts, bin_size, bin_method)
     return all_counts
 
 
-def count_coverage_5prime(samfile, flip=False):
+def count_coverage_5prime(samfile, flip=False, dtype=float64,
+        bin_size=None, bin_method="mean", reads=None, timer=None):
     """counts the coverage of 5' ends per base in a strand-specific manner
 
     On paired end reads, this will ignore read 2
 
     flip: Whether or not the strands should be flipped.
     This should be true for RNA-seq, and false for ChIP-exo
+
+    dtype, bin_size, bin_method, reads and timer: See count_coverage.
 """
 
-    all_counts = {}
-    plus_strands = []
-    minus_strands = []
-    chromosome_sizes = dict(list(zip(samfile.references, samfile.lengths)))
-    for i in chromosome_sizes:
-        chromosome_sizes[i] += 2  # allows to roll later, extra 0's never hurt
-    for reference in samfile.references:  # create an array for each reference
-        plus_strands.append(zeros((chromosome_sizes[reference],)))
-        minus_strands.append(zeros((chromosome_sizes[reference],)))
-    # iterate through each mapped read
-    for i, read in enumerate(samfile):
-        if read.is_read2:
-            warn("5' only data should not have been processed as Paired-end.")
-            continue
+    counter = _new_counter(samfile, _counter_dtype(samfile, dtype))
+    all_counts = _count_with_timer(samfile,
+        samfile if reads is None else reads, counter, _count_reads_5prime,
+        timer, flip)
+    if bin_size:
+        return _bin_all_counts(all_counts, bin_size, bin_method)
+    return all_counts
+
+
+def _split_references(references, lengths, n_shards):
+    """split the references into about n_shards (reference, start, end)
+    regions, with the number of regions per reference proportional to its
+    length"""
+    total = float(sum(lengths))
+    shards = []
+    for reference, length in zip(references, lengths):
+        n = max(1, int(round(n_shards * length / total)))
+        step = -(-length // n)  # ceiling division
+        for start in range(0, length, step):
+            shards.append((reference, start, min(start + step, length)))
+    return shards
+
+
+class _ShardCounter(object):
+    """counts the intervals of one reference into a window around a shard
+
+    Only the window from padding before the shard to padding after it is
+    allocated. The interval bounds inside the window are kept in a
+    difference array of the window, and the few outside it, such as the end
+    of an insert longer than padding, are kept in a list, so the deltas are
+    the same as those of a CoverageCounter of the whole reference.
+    """
+
+    def __init__(self, tid, length, start, end, dtype, padding=1000,
+            batch_size=100000):
+        self.tid = tid
+        self.length = length
+        self.first = max(start - padding, 0)
+        self.last = min(end + padding, length)
+        self.deltas = zeros((2, self.last - self.first + 1), dtype=dtype)
+        self.batch_size = batch_size
+        self._strands = []
+        self._starts = []
+        self._ends = []
+        self._outside = []
+
+    def add(self, track, start, end):
+        """count the interval [start, end) on a track of the reference"""
+        if end is None:
+            end = self.length
+        self._strands.append(track % 2)
+        self._starts.append(start)
+        self._ends.append(end)
+        if len(self._strands) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """apply all buffered intervals to the window"""
+        if len(self._strands) == 0:
+            return
+        strands = array(self._strands, dtype=int64)
+        starts = _slice_bounds(array(self._starts, dtype=int64), self.length)
+        ends = _slice_bounds(array(self._ends, dtype=int64), self.length)
+        self._strands = []
+        self._starts = []
+        self._ends = []
+        keep = ends > starts
+        self._apply(strands[keep], starts[keep], 1)
+        # intervals running to the end of the reference need no -1
+        keep &= ends < self.length
+        self._apply(strands[keep], ends[keep], -1)
+
+    def _apply(self, strands, positions, delta):
+        inside = (positions >= self.first) & (positions <= self.last)
+        func = add if delta > 0 else subtract
+        func.at(self.deltas, (strands[inside], positions[inside] - self.first),
+                1)
+        if not inside.all():
+            self._outside.append((strands[~inside], positions[~inside],
+                                  full((int((~inside).sum()),), delta)))
+
+    def compact(self):
+        """returns a list of (track, start, deltas) to merge into a
+        CoverageCounter of all references, see CoverageCounter.compact"""
+        self.flush()
+        results = []
+        for strand in (0, 1):
+            track = 2 * self.tid + strand
+            deltas = self.deltas[strand]
+            nonzero = deltas.nonzero()[0]
+            if len(nonzero) > 0:
+                # position i of a track is stored at index i + 1
+                results.append((track, self.first + nonzero[0] + 1,
+                                deltas[nonzero[0]:nonzero[-1] + 1].copy()))
+        for strands, positions, values in self._outside:
+            for strand, position, value in zip(strands.tolist(),
+                    positions.tolist(), values.tolist()):
+                # negative deltas wrap around in unsigned types, as they do
+                # in the difference array
+                results.append((2 * self.tid + strand, position + 1,
+                    array([value]).astype(self.deltas.dtype)))
+        return results
+
+
+def _count_shard(args):
+    """count the reads which start in one region of an indexed bam file
+
+    Only reads starting inside the region are counted, so reads which span
+    the boundary between two regions are counted exactly once. Only a window
+    around the region is allocated.
+
+    Returns a list of (track, start, deltas) to merge into a CoverageCounter.
+    """
+    sam_filename, (reference, start, end), include_insert, five_prime, \
+        dtype = args
+    samfile = pysam.Samfile(sam_filename)
+    tid = samfile.references.index(reference)
+    counter = _ShardCounter(tid, samfile.lengths[tid] + 2, start, end, dtype)
+    reads = (read for read in samfile.fetch(reference, start, end)
+             if start <= read.pos < end)
+    if five_prime:
+        _count_reads_5prime(reads, counter)
+    else:
+        _count_reads(reads, counter, include_insert=include_insert)
+    samfile.close()
+    return counter.compact()
+
+
+def count_coverage_parallel(sam_filename, workers, flip=False,
+        include_insert=False, five_prime=False, dtype=float64):
+    """counts coverage per base using several worker processes
+
+    The indexed bam file is split into regions which are counted in
+    parallel with fetch, and the results are merged. The counts are the
+    same as those of count_coverage (or count_coverage_5prime if five_prime
+    is set) on the whole file.
+
+    workers: The number of worker processes to use.
+
+    dtype: The type of the count arrays, see count_coverage.
+    """
+    samfile = pysam.Samfile(sam_filename)
+    references = samfile.references
+    dtype = _counter_dtype(samfile, dtype)
+    counter = _new_counter(samfile, dtype)
+    # several regions per worker keeps them all busy when reads are not
+    # spread evenly across the genome
+    shards = _split_references(references, samfile.lengths, 4 * workers)
+    samfile.close()
+    tasks = [(sam_filename, shard, include_insert, five_prime, dtype)
+             for shard in shards]
+    pool = Pool(workers)
+    try:
+        for result in pool.imap_unordered(_count_shard, tasks):
+            for track, start, deltas in result:
+                counter.merge(track, start, deltas)
+    finally:
+        pool.close()
+        pool.join()
+    return _collect_counts(references, counter, flip=flip)
+
+
+# How each product of count_coverage_multi is counted, as
+# (counts, flip). Products with the same counts share them, and a flip of
+# None is taken from the flip argument.
+PRODUCTS = {
+    "coverage": ("coverage", None),
+    "insert": ("insert", None),
+    "five_prime": ("five_prime", None),
+    "three_prime": ("three_prime", None),
+    # the settings of the makegff profiles
+    "rna": ("insert", True),
+    "exo": ("five_prime", False),
+}
+
+
+def count_coverage_cached(sam_filename, cache, flip=False,
+        include_insert=False, five_prime=False, workers=1):
+    """count_coverage (or count_coverage_5prime) through a CoverageCache
+
+    The counts are read from cache if the file was already counted with the
+    same settings. Otherwise they are counted (with workers processes if the
+    file is indexed) and stored in cache. Counts read from the cache are
+    read only, in the most compact integer type which holds them.
+    """
+    # include_insert has no effect on 5' counts
+    settings = {"flip": flip, "five_prime": five_prime,
+                "include_insert": include_insert and not five_prime}
+    all_counts = cache.get(sam_filename, settings)
+    if all_counts is not None:
+        return all_counts
+    samfile = pysam.Samfile(sam_filename)
+    if workers > 1 and samfile.has_index():
+        all_counts = count_coverage_parallel(sam_filename, workers,
+            flip=flip, include_insert=include_insert, five_prime=five_prime,
+            dtype="auto")
+    elif five_prime:
+        all_counts = count_coverage_5prime(samfile, flip=flip, dtype="auto")
+    else:
+        all_counts = count_coverage(samfile,
+            include_insert=include_insert, flip=flip, dtype="auto")
+    samfile.close()
+    cache.put(sam_filename, settings, all_counts)
+    return all_counts
+
+
+def count_coverage_multi(samfile, products=("coverage", "insert",
+        "five_prime", "three_prime"), flip=False, dtype=float64):
+    """counts several coverage products in a single pass over the reads
+
+    products: The names of the products to count, which are keys of
+    PRODUCTS. "coverage" counts whole reads, "insert" also includes the
+    insert between proper pairs, and "five_prime" and "three_prime" count
+    only one end of each read, ignoring read 2. "rna" and "exo" are counted
+    the same way as the makegff profiles.
+
+    flip: Whether or not the strands should be flipped, for the products
+    which are not profiles.
+
+    See count_coverage for dtype.
+
+    Returns ({product: all_counts}, (mapped, unmapped)), where each
+    all_counts is the same as count_coverage or count_coverage_5prime
+    would return and mapped and unmapped are the read totals of
+    mapped_percentage.calculate_mapped_percentage.
+    """
+    for product in products:
+        if product not in PRODUCTS:
+            raise ValueError("unknown product %s" % product)
+    dtype = _counter_dtype(samfile, dtype)
+    counters = {}
+    for product in products:
+        kind = PRODUCTS[product][0]
+        if kind not in counters:
+            counters[kind] = _new_counter(samfile, dtype)
+    coverage = counters.get("coverage")
+    insert = counters.get("insert")
+    five_prime = counters.get("five_prime")
+    three_prime = counters.get("three_prime")
+    ends_only = five_prime is not None or three_prime is not None
+    mapped = 0
+    unmapped = 0
+    skipped_read2 = False
+    for read in samfile:
         if read.is_unmapped:
+            unmapped += 1
             continue
-        if read.is_reverse:
-            minus_strands[read.tid][read.aend - 1] += 1
+        mapped += 1
+        if coverage is not None:
+            _add_read(coverage, read)
+        if insert is not None:
+            _add_read(insert, read, include_insert=True)
+        if ends_only:
+            if read.is_read2:
+                skipped_read2 = True
+                continue
+            if five_prime is not None:
+                _add_read_5prime(five_prime, read)
+            if three_prime is not None:
+                _add_read_3prime(three_prime, read)
+    if skipped_read2:
+        warn("5' and 3' only data should not have been processed as "
+             "Paired-end.")
+    all_products = {}
+    for product in products:
+        kind, product_flip = PRODUCTS[product]
+        if product_flip is None:
+            product_flip = flip
+        all_products[product] = _collect_counts(samfile.references,
+            counters[kind], flip=product_flip)
+    return all_products, (mapped, unmapped)
+
+
+class _WindowCounter(object):
+    """adds the intervals of one reference to the tracks of a window
+
+    Intervals are moved into window coordinates and clipped to the window,
+    so the window tracks hold the same counts as the matching part of a
+    whole reference.
+    """
+
+    def __init__(self, counter, window, start):
+        self.counter = counter
+        self.track = 2 * window
+        self.start = start
+
+    def add(self, track, start, end):
+        if end is not None:
+            end = max(end - self.start, 0)
+        self.counter.add(self.track + track % 2, max(start - self.start, 0),
+                         end)
+
+
+def merge_regions(regions):
+    """sort regions and merge the ones on the same reference which overlap
+    or touch
+
+    regions: a list of (reference, start, end) with 0-based, half open
+    coordinates, as used by pysam.
+    """
+    merged = []
+    for reference, start, end in sorted(regions):
+        if merged and merged[-1][0] == reference and start <= merged[-1][2]:
+            merged[-1][2] = max(merged[-1][2], end)
         else:
-            plus_strands[read.tid][read.pos] += 1
-    # store the results per reference
-    for i, reference in enumerate(samfile.references):
-        all_counts[reference] = {}
-        # roll shifts by 1, so the first base position (at index 0) is now at
-        # index 1
+            merged.append([reference, start, end])
+    return [tuple(region) for region in merged]
+
+
+def read_bed_regions(bed_filename):
+    """read (reference, start, end) regions from the first three columns of
+    a bed file"""
+    regions = []
+    with open(bed_filename) as infile:
+        for line in infile:
+            if line.startswith(("#", "track", "browser")) or not line.strip():
+                continue
+            fields = line.split("\t") if "\t" in line else line.split()
+            start, end = int(fields[1]), int(fields[2])
+            if start >= end:
+                raise ValueError("bed region %s:%d-%d in %s is empty"
+                                 % (fields[0], start, end, bed_filename))
+            regions.append((fields[0], start, end))
+    return regions
+
+
+def parse_regions(samfile, region_strings=(), bed_filename=None):
+    """build the list of regions to count from "chrom:start-end" strings
+    (1-based, inclusive like samtools) and a bed file
+
+    Regions are clipped to the reference lengths and merged when they
+    overlap. A region which starts past the end of its reference raises a
+    ValueError.
+    """
+    lengths = dict(zip(samfile.references, samfile.lengths))
+    regions = []
+    for region_string in region_strings:
+        reference, start, end = parse_region(region_string)
+        if start is None:
+            regions.append((reference, 0, lengths.get(reference, 0)))
+        else:
+            regions.append((reference, start - 1, end))
+    if bed_filename is not None:
+        regions.extend(read_bed_regions(bed_filename))
+    for reference, start, end in regions:
+        if reference not in lengths:
+            raise ValueError("reference %s is not in %s"
+                             % (reference, samfile.filename))
+        if start >= lengths[reference]:
+            raise ValueError("region %s:%d-%d is outside reference %s of "
+                             "length %d" % (reference, start + 1, end,
+                                            reference, lengths[reference]))
+    return merge_regions([(reference, max(start, 0),
+                           min(end, lengths[reference]))
+                          for reference, start, end in regions])
+
+
+def count_coverage_regions(samfile, regions, flip=False,
+        include_insert=False, five_prime=False, dtype=float64,
+        max_insert=1000):
+    """counts coverage only inside regions, using the bam index
+
+    Only reads near each region are read with fetch, and arrays are only
+    allocated for the regions, so a few loci can be counted without
+    scanning a whole file.
+
+    regions: a list of (reference, start, end) with 0-based, half open
+    coordinates, as returned by parse_regions.
+
+    max_insert: With include_insert, an insert can cover a region while
+    neither of its reads overlaps it, so reads up to this far outside the
+    region are also read. Longer inserts are missed.
+
+    See count_coverage for the other arguments.
+
+    Returns a list of (reference, first position, strands), where strands is
+    {"+": counts, "-": counts} and index i of the counts holds base
+    first position + i (1-based, as in the gff output).
+    """
+    regions = merge_regions(regions)
+    counter = CoverageCounter([end - start for reference, start, end in regions
+                               for strand in "+-"],
+                              dtype=_counter_dtype(samfile, dtype))
+    padding = max_insert if include_insert and not five_prime else 0
+    for i, (reference, start, end) in enumerate(regions):
+        window = _WindowCounter(counter, i, start)
+        reads = samfile.fetch(reference, max(start - padding, 0),
+                              end + padding)
+        if five_prime:
+            _count_reads_5prime(reads, window)
+        else:
+            _count_reads(reads, window, include_insert=include_insert)
+    segments = []
+    for i, (reference, start, end) in enumerate(regions):
+        plus_strand = counter.coverage(2 * i, shift=False)
+        minus_strand = counter.coverage(2 * i + 1, shift=False)
         if flip:
-            all_counts[reference]["-"] = roll(plus_strands[i], 1)
-            all_counts[reference]["+"] = roll(minus_strands[i], 1)
+            strands = {"-": plus_strand, "+": minus_strand}
         else:
-            all_counts[reference]["+"] = roll(plus_strands[i], 1)
-            all_counts[reference]["-"] = roll(minus_strands[i], 1)
+            strands = {"+": plus_strand, "-": minus_strand}
+        segments.append((reference, start + 1, strands))
+    return segments
+
+
+def _segments(all_counts):
+    """(reference, first position, strands) for each block of counts
+
+    all_counts may be the dict from count_coverage, in which the first
+    position of every reference is 0, or the list from
+    count_coverage_regions.
+    """
+    if isinstance(all_counts, dict):
+        return [(reference, 0, all_counts[reference])
+                for reference in all_counts]
     return all_counts
 
 
+OUTPUT_FORMATS = ["gff", "rle_gff", "bedgraph", "binary"]
+
+
+def _value_strings(values, str_func, factor):
+    """str_func(value, factor) for each value, formatting each distinct
+    value only once"""
+    distinct, inverse = unique(values, return_inverse=True)
+    strings = array([str_func(x, factor) for x in distinct.tolist()],
+                    dtype=object)
+    return strings[inverse.ravel()]
+
+
+def _write_records(output, line, starts, ends, values, str_func, factor,
+        chunk_size):
+    """fill in the two %d and the %s of line once per record
+
+    Each distinct value is formatted only once with str_func(value, factor),
+    and a whole chunk of lines is filled in with a single string formatting
+    operation and written as one block.
+    """
+    for chunk_start in range(0, len(starts), chunk_size):
+        chunk_end = min(chunk_start + chunk_size, len(starts))
+        fields = empty((chunk_end - chunk_start, 3), dtype=object)
+        fields[:, 0] = starts[chunk_start:chunk_end]
+        fields[:, 1] = ends[chunk_start:chunk_end]
+        fields[:, 2] = _value_strings(values[chunk_start:chunk_end],
+                                      str_func, factor)
+        output.write((line * len(fields)) % tuple(fields.ravel().tolist()))
+
+
+def _escape(value):
+    return str(value).replace("%", "%%")
+
+
+def write_gff_records(output, reference, track_name, strand, starts, ends,
+        values, str_func, factor=1, chunk_size=100000):
+    """write one gff line per record, formatting chunks of records at once
+
+    starts, ends and values are arrays with one entry per record, and the
+    values are written as str_func(value, factor).
+    """
+    line = "%s\t\t%s\t%%d\t%%d\t%%s\t%s\t.\t.\n" % (
+        _escape(reference), _escape(track_name), _escape(strand))
+    _write_records(output, line, starts, ends, values, str_func, factor,
+                   chunk_size)
+
+
+def write_bedgraph_records(output, reference, starts, ends, values,
+        str_func, factor=1, chunk_size=100000):
+    """write one bedGraph line per record, like write_gff_records
+
+    starts and ends are 0-based and half open, as bedGraph requires.
+    """
+    line = "%s\t%%d\t%%d\t%%s\n" % _escape(reference)
+    _write_records(output, line, starts, ends, values, str_func, factor,
+                   chunk_size)
+
+
+def write_sorted_records(output, strand_records, str_func,
+        chunk_size=100000):
+    """write the records of several strands as one list sorted by start
+
+    strand_records: A list of (prefix, suffix, starts, ends, values, factor)
+    for each strand. Each line is the prefix, the start and the end, the
+    value formatted as str_func(value, factor) and the suffix, with tabs
+    between the start, end and value. Records with the same start keep the
+    order of strand_records.
+    """
+    if len(strand_records) == 0:
+        return
+    prefixes = array([i[0] for i in strand_records], dtype=object)
+    suffixes = array([i[1] for i in strand_records], dtype=object)
+    which = concatenate([full(len(i[2]), n, dtype=uint8)
+                         for n, i in enumerate(strand_records)])
+    starts = concatenate([i[2] for i in strand_records])
+    ends = concatenate([i[3] for i in strand_records])
+    strings = concatenate([_value_strings(values, str_func, factor)
+        for prefix, suffix, s, e, values, factor in strand_records])
+    order = starts.argsort(kind="stable")
+    for chunk_start in range(0, len(order), chunk_size):
+        chunk = order[chunk_start:chunk_start + chunk_size]
+        fields = empty((len(chunk), 5), dtype=object)
+        fields[:, 0] = prefixes[which[chunk]]
+        fields[:, 1] = starts[chunk]
+        fields[:, 2] = ends[chunk]
+        fields[:, 3] = strings[chunk]
+        fields[:, 4] = suffixes[which[chunk]]
+        output.write(("%s%d\t%d\t%s%s" * len(fields))
+                     % tuple(fields.ravel().tolist()))
+
+
+def find_runs(counts, shifted=True):
+    """find the runs of consecutive positions with the same nonzero count
+
+    The run boundaries are found with a vectorized comparison of each
+    position with the next. Index 0 of the shifted count arrays wraps
+    around to the last base, so it is always kept as a run of its own
+    unless shifted is False.
+
+    Returns (starts, ends, values), where run i covers the positions
+    starts[i] to ends[i] - 1.
+    """
+    changes = (counts[1:] != counts[:-1]).nonzero()[0] + 1
+    if shifted and (len(changes) == 0 or changes[0] != 1):
+        changes = concatenate(([1], changes))
+    boundaries = concatenate(([0], changes, [len(counts)]))
+    starts = boundaries[:-1]
+    ends = boundaries[1:]
+    values = counts[starts]
+    nonzero = values != 0
+    return starts[nonzero], ends[nonzero], values[nonzero]
+
+
+BIN_METHODS = ["mean", "sum", "max"]
+
+
+def bin_counts(counts, bin_size, method="mean"):
+    """aggregate per base counts into bins of bin_size bases
+
+    The counts are reshaped into one row per bin and reduced along the rows,
+    so no python code runs per base. Bin k covers
+    counts[k * bin_size:(k + 1) * bin_size]. The last bin may be shorter,
+    and its mean is taken over the bases it has.
+
+    method: "mean", "sum" or "max"
+    """
+    if method not in BIN_METHODS:
+        raise ValueError("method must be one of %s" % ", ".join(BIN_METHODS))
+    n_full = len(counts) // bin_size
+    full = counts[:n_full * bin_size].reshape((n_full, bin_size))
+    binned = getattr(full, method)(axis=1)
+    rest = counts[n_full * bin_size:]
+    if len(rest) == 0:
+        return binned
+    return concatenate((binned, [getattr(rest, method)()]))
+
+
+def _bin_all_counts(all_counts, bin_size, method="mean"):
+    """bin each strand of the shifted arrays from count_coverage
+
+    Index 0 of the shifted arrays wraps around and the last index is
+    padding, so bin k of the result covers bases k * bin_size + 1 to
+    (k + 1) * bin_size.
+    """
+    binned = {}
+    for reference in all_counts:
+        binned[reference] = {}
+        for strand in all_counts[reference]:
+            binned[reference][strand] = bin_counts(
+                all_counts[reference][strand][1:-1], bin_size, method)
+    return binned
+
+
+def _records(counts, first, run_length=False, bin_size=None,
+        bin_method="mean"):
+    """find the (starts, ends, values) of the lines to write for a strand
+
+    counts: The counts of one strand, where index i holds base first + i.
+    first is 0 for the shifted arrays of whole references.
+
+    starts and ends are 1-based and inclusive, as in gff.
+    """
+    if bin_size:
+        if first == 0:
+            # index 0 wraps around and the last index is padding
+            counts = counts[1:-1]
+            first = 1
+        last = first + len(counts) - 1
+        counts = bin_counts(counts, bin_size, bin_method)
+    if run_length:
+        starts, ends, values = find_runs(counts, shifted=first == 0)
+        # gff ends are inclusive
+        ends = ends - 1
+    else:
+        starts = ends = counts.nonzero()[0]
+        values = counts[starts]
+    if bin_size:
+        starts = first + starts * bin_size
+        ends = minimum(first + ends * bin_size + bin_size - 1, last)
+    elif first != 0:
+        starts = starts + first
+        ends = ends + first
+    return starts, ends, values
+
+
+NORMALIZE_METHODS = ["cpm", "rpm", "depth"]
+
+
+def normalize_factor(normalize, library_size, target_depth=None):
+    """the factor counts are multiplied by for a normalize method
+
+    normalize: "cpm" or "rpm" (counts per million mapped reads, which are
+    the same), or "depth" (counts scaled to a library of target_depth mapped
+    reads). None leaves counts as they are.
+
+    library_size: The number of mapped reads.
+    """
+    if normalize is None:
+        return 1
+    if normalize not in NORMALIZE_METHODS:
+        raise ValueError("normalize must be one of %s"
+                         % ", ".join(NORMALIZE_METHODS))
+    if not library_size:
+        raise ValueError("normalizing needs the number of mapped reads")
+    if normalize == "depth":
+        if not target_depth:
+            raise ValueError("normalizing to a depth needs a target_depth")
+        return float(target_depth) / library_size
+    return 1e6 / library_size
+
+
+def _transform(values, scale=1, log2=False, pseudocount=0):
+    """scale values and take log2(values + pseudocount), on whole arrays"""
+    if scale != 1:
+        values = values * scale
+    if log2:
+        # values which are not positive become -inf or nan instead of
+        # raising an error. Small integer counts would be promoted to
+        # float32 only, which rounds differently from the float64 math.log.
+        with errstate(divide="ignore", invalid="ignore"):
+            values = numpy_log2(values.astype(float64) + pseudocount)
+    return values
+
+
+INDEX_FORMATS = ["gff", "rle_gff", "bedgraph"]
+
+
+def _check_index(output_format, log2=False):
+    """raise a ValueError if the output can not be written with index=True
+
+    An indexed bedGraph file has a single track, with the "-" strand as
+    negative values, so it can not hold log2 values, which can be negative
+    on either strand.
+    """
+    if output_format not in INDEX_FORMATS:
+        raise ValueError("only %s output can be indexed"
+                         % ", ".join(INDEX_FORMATS))
+    if output_format == "bedgraph" and log2:
+        raise ValueError("indexed bedgraph output can not be log2")
+
+
+def _check_binary(output_format, regions=False, bin_size=None,
+        normalize=None):
+    """raise a ValueError if binary output is asked for with regions,
+    bins or normalization, which the coverage store can not hold"""
+    if output_format == "binary" and (regions or bin_size or normalize):
+        raise ValueError("binary output needs whole, unbinned and "
+                         "unnormalized references")
+
+
+def index_coverage(filename, output_format):
+    """bgzip compress a gff or bedGraph file from write_coverage in place
+    and write a tabix index of it to [filename].tbi
+
+    The lines of each reference must be sorted by their start, as
+    write_coverage writes them with index=True.
+    """
+    _check_index(output_format)
+    plain_filename = filename + ".plain"
+    rename(filename, plain_filename)
+    try:
+        pysam.tabix_compress(plain_filename, filename, force=True)
+    finally:
+        remove(plain_filename)
+    if output_format == "bedgraph":
+        # the bed preset does not skip the track line
+        pysam.tabix_index(filename, seq_col=0, start_col=1, end_col=2,
+                          zerobased=True, line_skip=1, force=True)
+    else:
+        pysam.tabix_index(filename, preset="gff", force=True)
+
+
+def write_coverage(all_counts, out_filename, name, log2=False,
+        separate_strand=False, output_format="gff", bin_size=None,
+        bin_method="mean", normalize=None, library_size=None,
+        target_depth=None, pseudocount=0, index=False):
+    """write counts from count_coverage or count_coverage_regions to a file
+
+    output_format: "gff" writes one line per base with coverage. "rle_gff"
+    and "bedgraph" merge consecutive bases with the same coverage into one
+    line, which makes the file much smaller. "binary" writes the raw counts
+    to a coverage store which can be read with
+    coverage_store.CoverageStore, and ignores log2 and separate_strand.
+
+    bin_size: If given, write one line per bin of this many bases instead
+    of one per base, with the bin_method ("mean", "sum" or "max") of its
+    counts.
+
+    normalize, library_size and target_depth: See normalize_factor. Counts
+    are normalized before log2 is taken.
+
+    pseudocount: Added to the (normalized) counts before log2 is taken.
+
+    See write_samfile_to_gff for the other arguments.
+
+    index: Write a bgzip compressed file with a tabix index, which
+    coverage_gff.fetch_coverage can read any region of. The strands of each
+    reference are then written as one list sorted by position, and bases
+    before the first base of a reference are left out. A bedGraph file has
+    a single track, with the "-" strand as negative values, so it can not
+    be log2.
+
+    Returns the number of positions written, counting each base of a run or
+    bin.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("output_format must be one of %s"
+                         % ", ".join(OUTPUT_FORMATS))
+    if index:
+        _check_index(output_format, log2)
+    if output_format == "binary":
+        _check_binary(output_format, not isinstance(all_counts, dict),
+                      bin_size, normalize)
+        write_coverage_store(all_counts, out_filename, name=name)
+        return sum(len(all_counts[reference][strand])
+                   for reference in all_counts
+                   for strand in all_counts[reference])
+    segments = _segments(all_counts)
+    scale = normalize_factor(normalize, library_size, target_depth)
+    if log2 or normalize or (bin_size and bin_method == "mean"):
+        str_func = lambda x, s: "%.2f" % (x * s)
+    else:
+        str_func = lambda x, s: "%d" % (x * s)
+    run_length = output_format != "gff"
+    n_positions = 0
+    output = open(out_filename, "w")
+    if index:
+        if output_format == "bedgraph":
+            output.write('track type=bedGraph name="%s"\n' % name)
+        for reference, first, strands in segments:
+            strand_records = []
+            for strand in strands:
+                factor = 1 if strand == "+" else -1
+                starts, ends, values = _records(strands[strand], first,
+                    run_length, bin_size, bin_method)
+                values = _transform(values, scale, log2, pseudocount)
+                real = starts > 0
+                starts, ends, values = starts[real], ends[real], values[real]
+                n_positions += int((ends - starts + 1).sum())
+                if output_format == "bedgraph":
+                    strand_records.append(("%s\t" % reference, "\n",
+                        starts - 1, ends, values, factor))
+                else:
+                    track_name = "%s_(%s)" % (name, strand) \
+                        if separate_strand else name
+                    strand_records.append(
+                        ("%s\t\t%s\t" % (reference, track_name),
+                         "\t%s\t.\t.\n" % strand, starts, ends, values,
+                         factor))
+            write_sorted_records(output, strand_records, str_func)
+        output.close()
+        index_coverage(out_filename, output_format)
+        return n_positions
+    if output_format == "bedgraph":
+        # bedGraph has no strand column, so each strand is its own track
+        for strand in ["+", "-"]:
+            factor = 1 if strand == "+" else -1
+            track_name = "%s_(%s)" % (name, strand) if separate_strand else name
+            output.write('track type=bedGraph name="%s"\n' % track_name)
+            for reference, first, strands in segments:
+                starts, ends, values = _records(strands[strand], first,
+                    run_length, bin_size, bin_method)
+                values = _transform(values, scale, log2, pseudocount)
+                # bedGraph is 0-based and half open. Position 0 is not a
+                # real base.
+                real = starts > 0
+                write_bedgraph_records(output, reference, starts[real] - 1,
+                    ends[real], values[real], str_func, factor)
+                n_positions += int((ends[real] - starts[real] + 1).sum())
+        output.close()
+        return n_positions
+    for reference, first, strands in segments:
+        for strand in strands:
+            factor = 1 if strand == "+" else -1
+            track_name = "%s_(%s)" % (name, strand) if separate_strand else name
+            starts, ends, values = _records(strands[strand], first,
+                run_length, bin_size, bin_method)
+            values = _transform(values, scale, log2, pseudocount)
+            write_gff_records(output, reference, track_name, strand,
+                starts, ends, values, str_func, factor)
+            n_positions += int((ends - starts + 1).sum())
+    output.close()
+    return n_positions
+
+
 def write_samfile_to_gff(sam_filename, out_filename, flip=False, log2=False,
         separate_strand=False, include_insert=False, five_prime=False,
-        track=None):
+        track=None, workers=1, output_format="gff", regions=None,
+        regions_bed=None, bin_size=None, bin_method="mean", cache=None,
+        tee=None, timer=None, normalize=None, target_depth=None,
+        pseudocount=0, index=False):
     """write samfile object to an output object in a gff format
 
+    sam_filename: A sam or bam file, "-" to read one from stdin, or an open
+    binary file object such as the stdout of an aligner.
+
     flip: Whether or not the strands should be flipped.
     This should be true for RNA-seq, and false for ChIP-exo
 
@@ -133,33 +1234,209 @@ def write_samfile_to_gff(sam_filename, out_filename, flip=False, log2=False,
     as negative values (False)
 
     log2: Whether intensities should be reported as log2.
+
+    workers: The number of processes to count with. Using more than one
+    requires a sorted and indexed bam file.
+
+    output_format: "gff" (one line per base), "rle_gff" (one gff line per
+    run of bases with the same coverage), "bedgraph" or "binary" (a
+    memory-mapped coverage store of the raw counts).
+
+    regions: A list of "chrom:start-end" strings (1-based, inclusive) to
+    count, instead of the whole file.
+
+    regions_bed: A bed file of regions to count, instead of the whole file.
+    Counting only regions requires an indexed bam file, and counts them in
+    a single process.
+
+    bin_size: Write one line per bin of this many bases, instead of one
+    per base, with the bin_method ("mean", "sum" or "max") of its counts.
+
+    cache: A CoverageCache, or the directory of one, to read the counts from
+    if this file was already counted with the same settings, and to store
+    them in otherwise. Counts of regions are not cached.
+
+    tee: The name of a bam file to write every read to while it is counted,
+    so a stream does not have to be read again after it is converted.
+    Streams and tee are counted in a single process, without the cache.
+
+    timer: A PhaseTimer to record the time of each phase in, along with the
+    reads processed and skipped and the positions and bytes written. Its
+    finish() is called once the output is written.
+
+    normalize: "cpm" or "rpm" to write counts per million mapped reads, or
+    "depth" to scale counts to a library of target_depth mapped reads. The
+    number of mapped reads is taken from the index, or counted in the same
+    pass for a stream or a file without an index (which is then counted in
+    a single process, without the cache).
+
+    pseudocount: Added to the counts before log2 is taken, so bases without
+    coverage do not fail.
+
+    index: Write a bgzip compressed gff or bedGraph file with a tabix index
+    at [out_filename].tbi. See write_coverage.
     """
-    samfile = pysam.Samfile(sam_filename)
-    if five_prime:
-        all_counts = count_coverage_5prime(samfile, flip=flip)
+    if index:
+        _check_index(output_format, log2)
+    _check_binary(output_format, regions or regions_bed, bin_size, normalize)
+    if timer is not None and isinstance(sam_filename, str) and \
+            isfile(sam_filename):
+        timer.info.update(sam_filename=sam_filename,
+                          bytes_read=getsize(sam_filename))
+    with _timed(timer, "open"):
+        samfile = pysam.Samfile(sam_filename)
+    streamed = not isinstance(sam_filename, str) or sam_filename == "-"
+    if workers > 1 and not samfile.has_index():
+        warn("%s is not indexed, counting with a single process"
+             % sam_filename)
+        workers = 1
+    if isinstance(cache, str):
+        cache = CoverageCache(cache)
+    # without an index, mapped reads are tallied while they are counted
+    tally = {} if normalize and not samfile.has_index() else None
+    # the output only depends on the counts, so store them compactly
+    if streamed or tee is not None or tally is not None:
+        if regions or regions_bed:
+            raise ValueError("regions can not be counted from a stream, "
+                             "with tee or without an index")
+        tee_file = None
+        reads = samfile
+        if tally is not None:
+            reads = _tally_reads(reads, tally)
+        if tee is not None:
+            tee_file = pysam.Samfile(tee, "wb", template=samfile)
+            reads = _tee_reads(reads, tee_file)
+        try:
+            if five_prime:
+                all_counts = count_coverage_5prime(samfile, flip=flip,
+                    dtype="auto", reads=reads, timer=timer)
+            else:
+                all_counts = count_coverage(samfile,
+                    include_insert=include_insert, flip=flip, dtype="auto",
+                    reads=reads, timer=timer)
+        finally:
+            if tee_file is not None:
+                tee_file.close()
+    elif regions or regions_bed:
+        with _timed(timer, "count"):
+            all_counts = count_coverage_regions(samfile,
+                parse_regions(samfile, regions or (), regions_bed),
+                flip=flip, include_insert=include_insert,
+                five_prime=five_prime, dtype="auto")
+    elif cache is not None:
+        with _timed(timer, "count"):
+            all_counts = count_coverage_cached(sam_filename, cache,
+                flip=flip, include_insert=include_insert,
+                five_prime=five_prime, workers=workers)
+    elif workers > 1:
+        with _timed(timer, "count"):
+            all_counts = count_coverage_parallel(sam_filename, workers,
+                flip=flip, include_insert=include_insert,
+                five_prime=five_prime, dtype="auto")
+    elif five_prime:
+        all_counts = count_coverage_5prime(samfile, flip=flip, dtype="auto",
+                                           timer=timer)
     else:
         all_counts = count_coverage(samfile,
-            include_insert=include_insert, flip=flip)
+            include_insert=include_insert, flip=flip, dtype="auto",
+            timer=timer)
     if track is None:
         name = split(samfile.filename)[1]
     else:
         name = track
-    gff_base = "%s\t\t%s\t%d\t%d\t%s\t%s\t.\t.\n"
-    if log2:
-        str_func = lambda x, s: "%.2f" % (log(x, 2) * s)
+    library_size = None
+    if tally is not None:
+        library_size = tally["reads"] - tally["reads_unmapped"]
+    elif normalize:
+        library_size = samfile.mapped
+    with _timed(timer, "write"):
+        n_positions = write_coverage(all_counts, out_filename, name,
+            log2=log2, separate_strand=separate_strand,
+            output_format=output_format, bin_size=bin_size,
+            bin_method=bin_method, normalize=normalize,
+            library_size=library_size, target_depth=target_depth,
+            pseudocount=pseudocount, index=index)
+    samfile.close()
+    if timer is not None:
+        timer.info.update(out_filename=out_filename,
+                          output_format=output_format)
+        timer.count("positions_written", n_positions)
+        timer.count("bytes_written", getsize(out_filename))
+        timer.finish()
+
+
+def _extension(output_format, index=False):
+    """the file extension for an output format"""
+    extension = {"bedgraph": ".bedgraph", "binary": ".cov"}.get(
+        output_format, ".gff")
+    return extension + ".gz" if index else extension
+
+
+def _product_filenames(out_prefix, products, output_format="gff",
+        index=False):
+    """the {product: filename} write_samfile_products writes to"""
+    filenames = {}
+    for product in products:
+        if product == "mapped":
+            filenames[product] = out_prefix + ".mapped.txt"
+        else:
+            filenames[product] = out_prefix + "." + product + \
+                _extension(output_format, index)
+    return filenames
+
+
+def write_samfile_products(sam_filename, out_prefix, products, flip=False,
+        log2=False, separate_strand=False, track=None, output_format="gff",
+        bin_size=None, bin_method="mean", normalize=None, target_depth=None,
+        pseudocount=0, index=False):
+    """write several coverage products of a samfile, reading it only once
+
+    Each product from count_coverage_multi is written to
+    [out_prefix].[product].gff (or the extension of output_format). If
+    products includes "mapped", the mapped and unmapped read totals are
+    written to [out_prefix].mapped.txt. Normalized products use the mapped
+    reads from the same pass.
+
+    Returns a dict of {product: filename}.
+
+    See write_samfile_to_gff for the other arguments.
+    """
+    if index:
+        _check_index(output_format, log2)
+    _check_binary(output_format, bin_size=bin_size, normalize=normalize)
+    samfile = pysam.Samfile(sam_filename)
+    count_products = [i for i in products if i != "mapped"]
+    all_products, (mapped, unmapped) = count_coverage_multi(samfile,
+        count_products, flip=flip, dtype="auto")
+    if track is None:
+        name = split(samfile.filename)[1]
     else:
-        str_func = lambda x, s: "%d" % (x * s)
-    output = open(out_filename, "w")
-    for reference in all_counts:
-        for strand in all_counts[reference]:
-            factor = 1 if strand == "+" else -1
-            track_name = "%s_(%s)" % (name, strand) if separate_strand else name
-            counts = all_counts[reference][strand]
-            for i in counts.nonzero()[0]:
-                output.write(gff_base % (reference, track_name, i, i,
-                                         str_func(counts[i], factor), strand))
-    output.close()
+        name = track
+    filenames = _product_filenames(out_prefix, products, output_format, index)
+    for product in count_products:
+        write_coverage(all_products[product], filenames[product], name,
+            log2=log2, separate_strand=separate_strand,
+            output_format=output_format, bin_size=bin_size,
+            bin_method=bin_method, normalize=normalize, library_size=mapped,
+            target_depth=target_depth, pseudocount=pseudocount, index=index)
+    if "mapped" in products:
+        with open(filenames["mapped"], "w") as outfile:
+            outfile.write("mapped\tunmapped\tpercentage\n")
+            outfile.write("%d\t%d\t%.2f\n" % (mapped, unmapped,
+                mapped * 100. / max(mapped + unmapped, 1)))
     samfile.close()
+    return filenames
+
+
+def _write_timing(record, filename):
+    """write a PhaseTimer record as a line of json to filename, or to stdout
+    for -"""
+    import json
+    if filename == "-":
+        print(json.dumps(record, sort_keys=True))
+    else:
+        with open(filename, "a") as outfile:
+            outfile.write(json.dumps(record, sort_keys=True) + "\n")
 
 
 def main():
@@ -171,20 +1448,25 @@ def main():
 Below are some useage examples:
 
 Using a profile:
-RNAseq:   makegff.py --profile=rna alignment.bam
-ChIP-exo: makegff.py --profile=exo alignment.bam
+RNAseq:   python -m sequencing_utilities.makegff --profile=rna alignment.bam
+ChIP-exo: python -m sequencing_utilities.makegff --profile=exo alignment.bam
 
 Flip the reads
-makegff.py --flip alignment.bam""",
+python -m sequencing_utilities.makegff --flip alignment.bam""",
     formatter_class=RawDescriptionHelpFormatter)
 
     # TODO give more examples in help
 
     files = parser.add_argument_group("input output arguments")
-    files.add_argument("sam_filename", help="sam or bam file to convert to gff")
+    files.add_argument("sam_filename", help="""sam or bam file to convert to
+        gff, or - to read one from stdin""")
     files.add_argument("out_filename", nargs="?", default=None,
         help="""Name of gff file to be written. If unspecified, this will be
-        [the name of the samfile].gff if that file does not exist.""")
+        [the name of the samfile].gff if that file does not exist. Required
+        when reading from stdin.""")
+    files.add_argument("--tee", required=False, default=None,
+        help="""Write the reads to this bam file while counting them, such as
+            when streaming aligner output from stdin.""")
 
     # have various profiles to set settings
     parser.add_argument("--profile", required=False, default=None,
@@ -198,11 +1480,72 @@ makegff.py --flip alignment.bam""",
         help="""Report values as log2.""")
     display.add_argument("--track", required=False, default=None,
         help="""Name for the gff track.""")
+    display.add_argument("--format", required=False, default="gff",
+        choices=OUTPUT_FORMATS, dest="output_format",
+        help="""gff writes one line per base. rle_gff and bedgraph merge
+            consecutive bases with the same coverage into one line. binary
+            writes the raw counts to a memory-mapped coverage store.""")
+    display.add_argument("--bin_size", required=False, type=int,
+        default=None, help="""Write one line per bin of this many bases
+            instead of one per base.""")
+    display.add_argument("--bin_method", required=False, default="mean",
+        choices=BIN_METHODS, help="""How the counts in a bin are combined.""")
+    display.add_argument("--normalize", required=False, default=None,
+        choices=NORMALIZE_METHODS, help="""cpm and rpm report counts per
+            million mapped reads. depth scales counts to --target_depth mapped
+            reads.""")
+    display.add_argument("--target_depth", required=False, type=float,
+        default=None, help="""Number of mapped reads to scale to with
+            --normalize depth.""")
+    display.add_argument("--pseudocount", required=False, type=float,
+        default=0, help="""Added to the counts before --log2 is taken.""")
+    display.add_argument("--index", required=False, action="store_true",
+        help="""Write a bgzip compressed file with a tabix index, so any
+            region can be read without reading the whole file. Only for gff,
+            rle_gff and bedgraph output.""")
     display.add_argument("--same_track", required=False,
         action="store_true", help="""Put the negative strand on the same track
             as the positive track, only with negative numbers. The default is
             for the strands to be on separate tracks.""")
 
+    parser.add_argument("--products", required=False, default=None,
+        help="""Comma separated list of products to count in a single pass
+            over the file, from %s. Each one is written to
+            [out_filename].[product].gff, where out_filename defaults to the
+            name of the samfile. mapped writes the mapped and unmapped read
+            totals.""" % ", ".join(sorted(PRODUCTS) + ["mapped"]))
+
+    regions = parser.add_argument_group("region arguments",
+    "Count only some regions, using the index of a sorted bam file.")
+    regions.add_argument("--region", required=False, action="append",
+        default=None, dest="regions",
+        help="""Region to count, as chrom:start-end (1-based, inclusive) or
+            chrom. Can be given more than once.""")
+    regions.add_argument("--regions_bed", required=False, default=None,
+        help="""Bed file of regions to count.""")
+
+    parser.add_argument("--workers", required=False, type=int, default=1,
+        help="""Number of processes to count with. Using more than one
+            requires a sorted and indexed bam file.""")
+
+    cache = parser.add_argument_group("cache arguments",
+    "Keep counts on disk, so converting the same file with the same counting"
+    "\nsettings again does not count it again.")
+    cache.add_argument("--cache", required=False, action="store_true",
+        help="""Use the coverage cache in --cache_dir.""")
+    cache.add_argument("--cache_dir", required=False, default=None,
+        help="""Directory of the coverage cache. Defaults to the
+            SEQUTILS_CACHE_DIR environment variable or
+            ~/.cache/sequencing_utilities/coverage.""")
+    cache.add_argument("--cache_size", required=False, type=float,
+        default=10, help="""Size of the coverage cache in GB. The least
+            recently used counts are removed once it is larger.""")
+
+    parser.add_argument("--timing", required=False, default=None,
+        help="""Write the wall and cpu time of each phase, with the reads
+            processed and the positions and bytes written, as a json record
+            to this file, or to stdout for -.""")
+
     # settings can also be changed manually
     manual = parser.add_argument_group("manual counting arguments",
     "Manual control of how counting is done. These are can not be used when"
@@ -226,6 +1569,47 @@ makegff.py --flip alignment.bam""",
 
     args = parser.parse_args()
 
+    # products are counted in a single pass, so they can not be combined
+    # with the other ways of counting
+    if args.products is not None:
+        args.products = args.products.split(",")
+        for i in args.products:
+            if i not in PRODUCTS and i != "mapped":
+                from sys import exit
+                print("Error: unknown product %s" % i)
+                exit(1)
+        for i in ["profile", "five_prime", "include_insert", "regions",
+                  "regions_bed", "cache", "cache_dir", "timing"]:
+            if getattr(args, i) not in (None, False):
+                from sys import exit
+                print("Error: %s cannot be specified with products" % i)
+                exit(1)
+        if args.workers != 1:
+            from sys import exit
+            print("Error: workers cannot be specified with products")
+            exit(1)
+
+    if args.index:
+        try:
+            _check_index(args.output_format, args.log2)
+        except ValueError as e:
+            from sys import exit
+            print("Error: %s" % e)
+            exit(1)
+
+    try:
+        _check_binary(args.output_format, args.regions or args.regions_bed,
+                      args.bin_size, args.normalize)
+    except ValueError as e:
+        from sys import exit
+        print("Error: %s" % e)
+        exit(1)
+
+    if args.normalize == "depth" and args.target_depth is None:
+        from sys import exit
+        print("Error: --normalize depth needs a --target_depth")
+        exit(1)
+
     # prevent manual settings from being used with existing profiles
     if args.profile is not None:
         for i in ["flip", "five_prime", "include_insert"]:
@@ -234,6 +1618,18 @@ makegff.py --flip alignment.bam""",
                 print("Effor: %s cannot be specified with a profile" % i)
                 exit(1)
 
+    # a stream can only be read once, from start to end
+    if args.sam_filename == "-" and args.out_filename is None:
+        from sys import exit
+        print("Error: out_filename is required to read from stdin")
+        exit(1)
+    if args.sam_filename == "-" or args.tee is not None:
+        for i in ["products", "regions", "regions_bed"]:
+            if getattr(args, i) is not None:
+                from sys import exit
+                print("Error: %s cannot be specified with stdin or tee" % i)
+                exit(1)
+
     # handle profiles
     if args.profile == "rna":
         args.flip = True
@@ -249,19 +1645,53 @@ makegff.py --flip alignment.bam""",
     if out_filename == "" or isdir(out_filename):
         if args.sam_filename.endswith(".sam") or \
                 args.sam_filename.endswith(".bam"):
-            new_filename = args.sam_filename[:-3] + "gff"
+            new_filename = args.sam_filename[:-4]
         else:
-            new_filename = args.sam_filename + ".gff"
+            new_filename = args.sam_filename
+        if args.products is None:
+            new_filename += _extension(args.output_format, args.index)
         out_filename = join(out_filename, new_filename)
         if isfile(out_filename):  # do not want to overwrite existing
             raise IOError("File %s already exists" % out_filename)
+    if args.products is not None:
+        # out_filename is only a prefix, so check the files written from it
+        for filename in _product_filenames(out_filename, args.products,
+                args.output_format, args.index).values():
+            if isfile(filename):  # do not want to overwrite existing
+                raise IOError("File %s already exists" % filename)
 
     separate_strand = not args.same_track
 
+    timer = None
+    if args.timing is not None:
+        timer = PhaseTimer(callback=lambda record:
+                           _write_timing(record, args.timing))
+
+    coverage_cache = None
+    if args.cache or args.cache_dir is not None:
+        coverage_cache = CoverageCache(args.cache_dir,
+                                       int(args.cache_size * 2 ** 30))
+
+    if args.products is not None:
+        write_samfile_products(args.sam_filename, out_filename,
+            args.products, flip=args.flip, log2=args.log2,
+            separate_strand=separate_strand, track=args.track,
+            output_format=args.output_format, bin_size=args.bin_size,
+            bin_method=args.bin_method, normalize=args.normalize,
+            target_depth=args.target_depth, pseudocount=args.pseudocount,
+            index=args.index)
+        return
+
     write_samfile_to_gff(args.sam_filename, out_filename,
         five_prime=args.five_prime, include_insert=args.include_insert,
         separate_strand=separate_strand, flip=args.flip, log2=args.log2,
-        track=args.track)
+        track=args.track, workers=args.workers,
+        output_format=args.output_format, regions=args.regions,
+        regions_bed=args.regions_bed, bin_size=args.bin_size,
+        bin_method=args.bin_method, cache=coverage_cache, tee=args.tee,
+        timer=timer, normalize=args.normalize,
+        target_depth=args.target_depth, pseudocount=args.pseudocount,
+        index=args.index)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# PYTHON_ARGCOMPLETE_OK
+import csv
+from os.path import getmtime, getsize, isfile
+from multiprocessing import Pool
+from time import time
+
+try:
+    import pysam
+except ImportError as e:
+    print(e);
+
+from .makegff import write_samfile_to_gff, _extension
+
+# column names accepted for the input and output files in a manifest,
+# including those of docker_run/run_bam2gff_docker.py
+SAM_COLUMNS = ["sam_filename", "host_bam_I"]
+OUT_COLUMNS = ["out_filename", "host_gff_O"]
+
+
+def read_manifest(filename):
+    """read (sam_filename, out_filename) pairs from a csv manifest
+
+    The csv needs a column with the input file (sam_filename or
+    host_bam_I), and may have a column with the output file (out_filename
+    or host_gff_O). Rows without an output file get None.
+    """
+    jobs = []
+    with open(filename, "r") as csvfile:
+        reader = csv.DictReader(csvfile)
+        sam_column = [i for i in SAM_COLUMNS if i in reader.fieldnames]
+        out_column = [i for i in OUT_COLUMNS if i in reader.fieldnames]
+        if len(sam_column) == 0:
+            raise ValueError("%s needs one of the columns %s" %
+                             (filename, ", ".join(SAM_COLUMNS)))
+        for row in reader:
+            out_filename = row[out_column[0]] if out_column else None
+            jobs.append((row[sam_column[0]], out_filename or None))
+    return jobs
+
+
+def default_out_filename(sam_filename, output_format="gff"):
+    """[the name of the samfile].gff (or the extension of output_format)"""
+    if sam_filename.endswith(".sam") or sam_filename.endswith(".bam"):
+        sam_filename = sam_filename[:-4]
+    return sam_filename + _extension(output_format)
+
+
+def is_current(sam_filename, out_filename):
+    """whether out_filename exists and is newer than sam_filename"""
+    return isfile(out_filename) and \
+        getmtime(out_filename) >= getmtime(sam_filename)
+
+
+def _count_reads(sam_filename):
+    """the number of reads from the bam index, or None without one"""
+    try:
+        samfile = pysam.Samfile(sam_filename)
+        n_reads = samfile.mapped + samfile.unmapped
+        samfile.close()
+        return n_reads
+    except (ValueError, AttributeError):
+        return None
+
+
+def _run_job(args):
+    sam_filename, out_filename, settings = args
+    start = time()
+    write_samfile_to_gff(sam_filename, out_filename, **settings)
+    return {"sam_filename": sam_filename, "out_filename": out_filename,
+            "seconds": time() - start, "bytes": getsize(sam_filename),
+            "reads": _count_reads(sam_filename)}
+
+
+def write_samfiles_to_gff(jobs, processes=1, force=False, verbose=True,
+        **settings):
+    """run write_samfile_to_gff on many files with a pool of processes
+
+    jobs: A list of sam filenames, or (sam_filename, out_filename) pairs
+    such as those from read_manifest. Missing out_filenames default to
+    [the name of the samfile].gff.
+
+    processes: The number of files to convert at the same time. Each file
+    is counted in a single process.
+
+    force: Convert files even when the output is newer than the input.
+    Otherwise those files are skipped.
+
+    settings: Passed on to write_samfile_to_gff.
+
+    Returns a list with a dict for each converted file, with the
+    filenames, the seconds taken, the size of the input in bytes and the
+    number of reads (None for files without an index).
+    """
+    settings.pop("workers", None)
+    tasks = []
+    for job in jobs:
+        if isinstance(job, str):
+            job = (job, None)
+        sam_filename, out_filename = job
+        if out_filename is None:
+            out_filename = default_out_filename(sam_filename,
+                settings.get("output_format", "gff"))
+        if not force and is_current(sam_filename, out_filename):
+            if verbose:
+                print("skipping %s, %s is current" %
+                      (sam_filename, out_filename))
+            continue
+        tasks.append((sam_filename, out_filename, settings))
+    results = []
+    start = time()
+    pool = Pool(max(min(processes, len(tasks)), 1))
+    try:
+        for result in pool.imap_unordered(_run_job, tasks):
+            if verbose:
+                rate = "%.2f MB/s" % (result["bytes"] / 1e6 /
+                                     max(result["seconds"], 1e-9))
+                if result["reads"] is not None:
+                    rate += ", %d reads/s" % (result["reads"] /
+                                             max(result["seconds"], 1e-9))
+                print("converted %s in %.2f seconds (%s)" %
+                      (result["sam_filename"], result["seconds"], rate))
+            results.append(result)
+    finally:
+        pool.close()
+        pool.join()
+    if verbose:
+        print("converted %d files in %.2f seconds, skipped %d" %
+              (len(results), time() - start, len(jobs) - len(tasks)))
+    return results
+
+
+def main():
+    from argparse import ArgumentParser
+    try:
+        from argcomplete import autocomplete
+    except ImportError:
+        autocomplete = None
+
+    parser = ArgumentParser("convert many samfiles to gff files")
+    parser.add_argument("sam_filenames", nargs="*",
+        help="sam or bam files to convert to gff")
+    parser.add_argument("--manifest", required=False, default=None,
+        help="""csv file with a sam_filename (or host_bam_I) column and an
+            optional out_filename (or host_gff_O) column""")
+    parser.add_argument("--processes", required=False, type=int, default=1,
+        help="number of files to convert at the same time")
+    parser.add_argument("--force", required=False, action="store_true",
+        help="convert files even if the output is newer than the input")
+    parser.add_argument("--profile", required=False, default=None,
+        choices=["rna", "exo"],
+        help="""Use predefined settings from an existing profile""")
+    parser.add_argument("--format", required=False, default="gff",
+        choices=["gff", "rle_gff", "bedgraph", "binary"],
+        dest="output_format", help="""format of the output files""")
+    parser.add_argument("--same_track", required=False,
+        action="store_true", help="""Put the negative strand on the same track
+            as the positive track, only with negative numbers.""")
+    if autocomplete is not None:
+        autocomplete(parser)
+    args = parser.parse_args()
+
+    jobs = list(args.sam_filenames)
+    if args.manifest is not None:
+        jobs.extend(read_manifest(args.manifest))
+    settings = {"separate_strand": not args.same_track,
+                "output_format": args.output_format}
+    if args.profile == "rna":
+        settings.update(flip=True, include_insert=True, five_prime=False)
+    elif args.profile == "exo":
+        settings.update(flip=False, include_insert=False, five_prime=True)
+    write_samfiles_to_gff(jobs, processes=args.processes, force=args.force,
+                          **settings)
+
+if __name__ == "__main__":
+    main()
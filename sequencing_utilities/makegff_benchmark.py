@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# PYTHON_ARGCOMPLETE_OK
+"""
+Benchmarks the counting modes and writers of makegff on synthetic bam
+files, reporting reads/s, positions/s and peak memory for each phase.
+
+Results can be saved as a baseline and later runs compared against it, so
+a change to the counting or writing code can be checked for regressions.
+"""
+import json
+import os
+import resource
+import shutil
+import tempfile
+from multiprocessing import Pipe, Process
+from traceback import format_exc
+from os.path import join
+from time import time
+
+from numpy import array, random as numpy_random
+
+try:
+    import pysam
+except ImportError as e:
+    print(e);
+
+from .makegff import count_coverage, count_coverage_5prime, \
+    count_coverage_parallel, count_coverage_multi, write_coverage, \
+    PRODUCTS
+
+COUNT_PHASES = ["coverage", "insert", "five_prime", "parallel", "multi"]
+WRITE_PHASES = ["gff", "rle_gff", "bedgraph", "binary"]
+PHASES = COUNT_PHASES + WRITE_PHASES
+
+
+def make_synthetic_bam(filename, n_reads=100000, read_length=100,
+        reference_lengths=(1000000,), paired=False, strand_bias=0.5,
+        insert_size=300, seed=0):
+    """write a sorted and indexed bam file of randomly placed reads
+
+    n_reads: The number of reads, which for paired data is twice the number
+    of fragments.
+
+    reference_lengths: The length of each reference, named chr1, chr2...
+    Reads are spread over the references in proportion to their length.
+
+    strand_bias: The fraction of reads (or fragments) on the + strand. 0.5
+    is an unstranded library, 1 or 0 is a fully stranded one.
+
+    insert_size: The length of each fragment for paired data.
+    """
+    rng = numpy_random.RandomState(seed)
+    n_fragments = n_reads // 2 if paired else n_reads
+    span = insert_size if paired else read_length
+    references = ["chr%d" % (i + 1) for i in range(len(reference_lengths))]
+    weights = [float(length) for length in reference_lengths]
+    tids = rng.choice(len(references), size=n_fragments,
+                      p=[w / sum(weights) for w in weights])
+    starts = (rng.random_sample(n_fragments) *
+              (array(reference_lengths)[tids] - span)).astype(int)
+    forward = rng.random_sample(n_fragments) < strand_bias
+    # (tid, pos, fragment, flag, mate pos, template length) of every read
+    segments = []
+    for i in range(n_fragments):
+        tid, start = int(tids[i]), int(starts[i])
+        if not paired:
+            segments.append((tid, start, i, 0 if forward[i] else 16, -1, 0))
+            continue
+        end = start + insert_size - read_length
+        if forward[i]:
+            # read 1 forward on the left, read 2 reverse on the right
+            segments.append((tid, start, i, 99, end, insert_size))
+            segments.append((tid, end, i, 147, start, -insert_size))
+        else:
+            # read 2 forward on the left, read 1 reverse on the right
+            segments.append((tid, start, i, 163, end, insert_size))
+            segments.append((tid, end, i, 83, start, -insert_size))
+    segments.sort()
+    header = {"HD": {"VN": "1.0", "SO": "coordinate"},
+              "SQ": [{"SN": name, "LN": length} for name, length
+                     in zip(references, reference_lengths)]}
+    sequence = "A" * read_length
+    qualities = pysam.qualitystring_to_array("I" * read_length)
+    outfile = pysam.AlignmentFile(filename, "wb", header=header)
+    for tid, start, fragment, flag, mate_start, template_length in segments:
+        read = pysam.AlignedSegment()
+        read.query_name = "read%d" % fragment
+        read.query_sequence = sequence
+        read.query_qualities = qualities
+        read.flag = flag
+        read.reference_id = tid
+        read.reference_start = start
+        read.mapping_quality = 255
+        read.cigartuples = [(0, read_length)]
+        if paired:
+            read.next_reference_id = tid
+            read.next_reference_start = mate_start
+            read.template_length = template_length
+        outfile.write(read)
+    outfile.close()
+    pysam.index(filename)
+    return filename
+
+
+def _peak_rss_mb():
+    """the peak resident memory of this process, or of its largest child
+    process, in MB"""
+    # ru_maxrss is in kB on linux and in bytes on mac
+    maxrss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                 resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if os.uname()[0] == "Darwin":
+        maxrss /= 1024
+    return maxrss / 1024.
+
+
+def _count(phase, sam_filename, workers):
+    if phase == "parallel":
+        return count_coverage_parallel(sam_filename, workers, dtype="auto")
+    samfile = pysam.Samfile(sam_filename)
+    if phase == "five_prime":
+        all_counts = count_coverage_5prime(samfile, dtype="auto")
+    elif phase == "multi":
+        all_counts = count_coverage_multi(samfile, sorted(PRODUCTS),
+                                          dtype="auto")
+    else:
+        all_counts = count_coverage(samfile, dtype="auto",
+                                    include_insert=(phase == "insert"))
+    samfile.close()
+    return all_counts
+
+
+def _run_phase(phase, sam_filename, workers, out_dir):
+    """time one phase"""
+    if phase in WRITE_PHASES:
+        all_counts = _count("coverage", sam_filename, workers)
+        out_filename = join(out_dir, "benchmark." + phase)
+        start, start_cpu = time(), os.times()
+        write_coverage(all_counts, out_filename, "benchmark",
+                       separate_strand=True, output_format=phase)
+        bytes_written = os.path.getsize(out_filename)
+        os.remove(out_filename)
+    else:
+        start, start_cpu = time(), os.times()
+        _count(phase, sam_filename, workers)
+        bytes_written = 0
+    seconds = time() - start
+    end_cpu = os.times()
+    cpu_seconds = (end_cpu[0] - start_cpu[0]) + (end_cpu[1] - start_cpu[1])
+    return {"phase": phase, "seconds": seconds, "cpu_seconds": cpu_seconds,
+            "peak_rss_mb": _peak_rss_mb(), "bytes": bytes_written}
+
+
+def _phase_process(connection, args):
+    try:
+        connection.send(_run_phase(*args))
+    except Exception:
+        connection.send(format_exc())
+    connection.close()
+
+
+def _run_phase_process(*args):
+    """run _run_phase in a fresh process, so its peak memory is its own"""
+    receiver, sender = Pipe(False)
+    process = Process(target=_phase_process, args=(sender, args))
+    process.start()
+    result = receiver.recv()
+    process.join()
+    if not isinstance(result, dict):
+        raise RuntimeError("benchmark of %s failed:\n%s" % (args[0], result))
+    return result
+
+
+def run_benchmarks(sam_filename, phases=PHASES, workers=2, repeat=1):
+    """time each phase on sam_filename, keeping the fastest of repeat runs
+
+    Counting phases time count_coverage ("coverage" and "insert"),
+    count_coverage_5prime, count_coverage_parallel with workers processes
+    and count_coverage_multi of every product. Writing phases time
+    write_coverage of precomputed counts in each output format.
+
+    Returns {phase: {"seconds", "cpu_seconds", "reads_per_second",
+    "positions_per_second", "peak_rss_mb", "bytes"}}, where positions are
+    the bases of the references on both strands. Each phase runs in its own
+    process. The peak memory of a writing phase includes counting the
+    coverage it writes, and that of the parallel phase is the largest of
+    its processes.
+    """
+    samfile = pysam.Samfile(sam_filename)
+    n_reads = samfile.mapped + samfile.unmapped
+    n_positions = 2 * sum(samfile.lengths)
+    samfile.close()
+    out_dir = tempfile.mkdtemp()
+    results = {}
+    try:
+        for phase in phases:
+            if phase not in PHASES:
+                raise ValueError("unknown phase %s" % phase)
+            for i in range(repeat):
+                result = _run_phase_process(phase, sam_filename, workers,
+                                            out_dir)
+                if phase in results and \
+                        results[phase]["seconds"] <= result["seconds"]:
+                    continue
+                seconds = max(result["seconds"], 1e-9)
+                result["reads_per_second"] = n_reads / seconds
+                result["positions_per_second"] = n_positions / seconds
+                results[phase] = result
+    finally:
+        shutil.rmtree(out_dir)
+    return results
+
+
+def compare_results(results, baseline, tolerance=0.1):
+    """returns a list of (phase, metric, baseline, result) which regressed
+    by more than tolerance compared to baseline"""
+    regressions = []
+    for phase in results:
+        if phase not in baseline:
+            continue
+        old, new = baseline[phase], results[phase]
+        if new["seconds"] > old["seconds"] * (1 + tolerance):
+            regressions.append((phase, "seconds", old["seconds"],
+                                new["seconds"]))
+        if new["peak_rss_mb"] > old["peak_rss_mb"] * (1 + tolerance):
+            regressions.append((phase, "peak_rss_mb", old["peak_rss_mb"],
+                                new["peak_rss_mb"]))
+    return regressions
+
+
+def print_results(results, baseline=None):
+    print("%-12s %10s %14s %16s %12s" % ("phase", "seconds", "reads/s",
+                                         "positions/s", "peak MB"))
+    for phase in PHASES:
+        if phase not in results:
+            continue
+        result = results[phase]
+        line = "%-12s %10.3f %14.0f %16.0f %12.1f" % (phase,
+            result["seconds"], result["reads_per_second"],
+            result["positions_per_second"], result["peak_rss_mb"])
+        if baseline is not None and phase in baseline:
+            line += "  (%.2fx baseline)" % (baseline[phase]["seconds"] /
+                                           max(result["seconds"], 1e-9))
+        print(line)
+
+
+def main():
+    from argparse import ArgumentParser
+    try:
+        from argcomplete import autocomplete
+    except ImportError:
+        autocomplete = None
+
+    parser = ArgumentParser("benchmark makegff on a synthetic bam file")
+    parser.add_argument("--bam", required=False, default=None,
+        help="""bam file to benchmark on. It is generated with the settings
+            below if it does not exist. Defaults to a temporary file.""")
+    parser.add_argument("--reads", required=False, type=int, default=100000,
+        help="number of reads to generate")
+    parser.add_argument("--read_length", required=False, type=int,
+        default=100, help="length of the generated reads")
+    parser.add_argument("--reference_length", required=False, type=int,
+        action="append", default=None,
+        help="""length of a generated reference. Can be given more than once.
+            Defaults to one reference of 1000000 bases.""")
+    parser.add_argument("--paired", required=False, action="store_true",
+        help="generate paired end reads")
+    parser.add_argument("--insert_size", required=False, type=int,
+        default=300, help="fragment length of generated paired end reads")
+    parser.add_argument("--strand_bias", required=False, type=float,
+        default=0.5, help="""fraction of generated reads on the + strand.
+            0.5 is unstranded.""")
+    parser.add_argument("--phases", required=False,
+        default=",".join(PHASES),
+        help="comma separated phases to run, from %s" % ", ".join(PHASES))
+    parser.add_argument("--workers", required=False, type=int, default=2,
+        help="number of processes for the parallel phase")
+    parser.add_argument("--repeat", required=False, type=int, default=1,
+        help="run each phase this many times and keep the fastest")
+    parser.add_argument("--save", required=False, default=None,
+        help="save the results as a json baseline")
+    parser.add_argument("--compare", required=False, default=None,
+        help="""compare to a json baseline, and exit with an error if a phase
+            is more than --tolerance slower or larger""")
+    parser.add_argument("--tolerance", required=False, type=float,
+        default=0.1, help="allowed regression compared to the baseline")
+    if autocomplete is not None:
+        autocomplete(parser)
+    args = parser.parse_args()
+
+    temp_dir = None
+    sam_filename = args.bam
+    if sam_filename is None:
+        temp_dir = tempfile.mkdtemp()
+        sam_filename = join(temp_dir, "synthetic.bam")
+    try:
+        if not os.path.isfile(sam_filename):
+            start = time()
+            make_synthetic_bam(sam_filename, n_reads=args.reads,
+                read_length=args.read_length,
+                reference_lengths=args.reference_length or [1000000],
+                paired=args.paired, strand_bias=args.strand_bias,
+                insert_size=args.insert_size)
+            print("generated %s in %.2f seconds" %
+                  (sam_filename, time() - start))
+        results = run_benchmarks(sam_filename, args.phases.split(","),
+                                 workers=args.workers, repeat=args.repeat)
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir)
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as infile:
+            baseline = json.load(infile)
+    print_results(results, baseline)
+    if args.save is not None:
+        with open(args.save, "w") as outfile:
+            json.dump(results, outfile, indent=2, sort_keys=True)
+    if baseline is not None:
+        regressions = compare_results(results, baseline, args.tolerance)
+        for phase, metric, old, new in regressions:
+            print("regression in %s: %s %.3f -> %.3f" %
+                  (phase, metric, old, new))
+        if regressions:
+            from sys import exit
+            exit(1)
+
+if __name__ == "__main__":
+    main()
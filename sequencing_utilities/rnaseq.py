@@ -1,8 +1,9 @@
 ﻿#!/usr/bin/env python
 import os
+import subprocess
 
 #from .seq_settings import bowtie, indexes_dir, cufflinks
-from .sam2bam import convert_samfile
+from .sam2bam import convert_samfile, sort_bamfile
 from .makegff import write_samfile_to_gff
 
 
@@ -10,7 +11,8 @@ def process_rnaseq(basename, dirname_I, dirname_O, organism, indexes_dir='../ind
                    bowtie='bowtie',cufflinks='cufflinks',samtools='samtools',cuffdiff='cuffdiff',
                    htseqcount='htseq-count',htseqqa = 'htseq-qa',verbose_I=True,
                    library_type='fr-firststrand',index_type = '.gtf',
-                   bowtie_options_I = '',cufflinks_options_I = ''):
+                   bowtie_options_I = '',cufflinks_options_I = '',
+                   stream_coverage=False):
     '''Process RNA sequencing data from the commandline
 
     Input:
@@ -25,6 +27,9 @@ def process_rnaseq(basename, dirname_I, dirname_O, organism, indexes_dir='../ind
     verbose_I = boolean
     bowtie_options_I = string, additional command line arguments not explicitly provided
     cufflinks_options_I = string, additional command line arguments not explicitly provided
+    stream_coverage = boolean, count the coverage while the bowtie output is
+        streamed into the bam file, instead of writing a .sam file and
+        reading the alignments again afterwards
 
     Output:
     
@@ -64,6 +69,8 @@ def process_rnaseq(basename, dirname_I, dirname_O, organism, indexes_dir='../ind
     else:
         print('index_type not recognized.')
     fna_index = indexes_dir + organism + ".fna"
+    # bowtie writes to stdout without an output file
+    sam_output = "" if stream_coverage else base_output + ".sam"
 
     # generate the bowtie command based on input
     if paired=='paired':
@@ -103,8 +110,8 @@ def process_rnaseq(basename, dirname_I, dirname_O, organism, indexes_dir='../ind
             (insertsize, threads, trim3)
         if bowtie_options_I:
             bowtie_options+=" %s" %(bowtie_options_I);
-        bowtie_command = "%s %s -S %s -1 %s -2 %s %s.sam" % \
-            (bowtie, bowtie_options, indexes_dir + organism, p1_str, p2_str, base_output)
+        bowtie_command = "%s %s -S %s -1 %s -2 %s %s" % \
+            (bowtie, bowtie_options, indexes_dir + organism, p1_str, p2_str, sam_output)
     elif paired=='unpaired':
         p1 = []
         for fastq_file in fastq_files:
@@ -126,7 +133,7 @@ def process_rnaseq(basename, dirname_I, dirname_O, organism, indexes_dir='../ind
             (threads, trim3)
         if bowtie_options_I:
             bowtie_options+=" %s" %(bowtie_options_I);
-        bowtie_command = "%s %s -S %s %s %s.sam" % (bowtie, bowtie_options, indexes_dir + organism, p1_str, base_output)
+        bowtie_command = "%s %s -S %s %s %s" % (bowtie, bowtie_options, indexes_dir + organism, p1_str, sam_output)
     elif paired=='mixed':
         p1 = []
         for fastq_file in fastq_files:
@@ -151,15 +158,24 @@ def process_rnaseq(basename, dirname_I, dirname_O, organism, indexes_dir='../ind
             (insertsize, threads, trim3)
         if bowtie_options_I:
             bowtie_options+=" %s" %(bowtie_options_I);
-        bowtie_command = "%s %s --verbose -S %s --12 %s %s.sam" % \
-            (bowtie, bowtie_options, indexes_dir + organism, p1_str, base_output)
+        bowtie_command = "%s %s --verbose -S %s --12 %s %s" % \
+            (bowtie, bowtie_options, indexes_dir + organism, p1_str, sam_output)
 
     # run the bowtie command
     print(bowtie_command)
-    os.system(bowtie_command)
+    if stream_coverage:
+        # count coverage while the alignments are written to an unsorted bam
+        aligner = subprocess.Popen(bowtie_command, shell=True, stdout=subprocess.PIPE)
+        write_samfile_to_gff(aligner.stdout, base_output + ".gff", flip=True, separate_strand=True,
+                             track=os.path.split(base_output)[1] + ".bam", tee=base_output + ".unsorted.bam")
+        aligner.wait()
+        # sort the bam for cufflinks
+        sort_bamfile(base_output, samtools=samtools)
+    else:
+        os.system(bowtie_command)
 
-    # convert .sam to .bam for cufflinks
-    convert_samfile(base_output + ".sam", sort=True, force=True, samtools=samtools,threads=threads)
+        # convert .sam to .bam for cufflinks
+        convert_samfile(base_output + ".sam", sort=True, force=True, samtools=samtools,threads=threads)
 
     ## make a sorted samfile
     #os.system("%s view -h %s.bam > %s.unsorted.sam" % (samtools, base_output, base_output))
@@ -180,7 +196,8 @@ def process_rnaseq(basename, dirname_I, dirname_O, organism, indexes_dir='../ind
     os.system(cufflinks_command)
 
     # convert .bam to .gff
-    write_samfile_to_gff(base_output + ".bam", base_output + ".gff", flip=True, separate_strand=True)
+    if not stream_coverage:
+        write_samfile_to_gff(base_output + ".bam", base_output + ".gff", flip=True, separate_strand=True)
 
     # cleanup
     #os.system("rm %s.unsorted.sam" % (base_output))
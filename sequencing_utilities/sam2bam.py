@@ -21,17 +21,28 @@ def convert_samfile(samfile, sort=False, force=False, verbose=True,samtools='sam
         # sam to unsorted bam
         #command_strs.append("%s view -bS -@ %d %s -o %s.unsorted.bam" % (samtools, threads, samfile, base_name))
         command_strs.append("%s view -bS %s -o %s.unsorted.bam" % (samtools, samfile, base_name))
-        # unsorted bam to sorted bam
-        #command_strs.append("%s sort -@ %d %s.unsorted.bam %s" % (samtools, threads, base_name, base_name))
-        command_strs.append("%s sort %s.unsorted.bam %s" % (samtools, base_name, base_name))
-        # creation of index
-        command_strs.append("%s index %s" % (samtools, bamfile))
-        # removal of unsorted bam
-        command_strs.append("rm %s.unsorted.bam" % base_name)
+        command_strs.extend(_sort_commands(base_name, samtools))
     else:
         command_strs = ["%s view -bS %s -o %s" % (samtools, samfile, bamfile)]
     if verbose:
         print("starting processing on " + samfile)
+    _run_commands(command_strs, verbose)
+
+
+def _sort_commands(base_name, samtools='samtools'):
+    """commands to sort [base_name].unsorted.bam into [base_name].bam"""
+    command_strs = []
+    # unsorted bam to sorted bam
+    #command_strs.append("%s sort -@ %d %s.unsorted.bam %s" % (samtools, threads, base_name, base_name))
+    command_strs.append("%s sort %s.unsorted.bam %s" % (samtools, base_name, base_name))
+    # creation of index
+    command_strs.append("%s index %s.bam" % (samtools, base_name))
+    # removal of unsorted bam
+    command_strs.append("rm %s.unsorted.bam" % base_name)
+    return command_strs
+
+
+def _run_commands(command_strs, verbose=True):
     start = time()
     for command_str in command_strs:
         if verbose:
@@ -41,6 +52,16 @@ def convert_samfile(samfile, sort=False, force=False, verbose=True,samtools='sam
         print("done (%.2f seconds)" % (time() - start))
 
 
+def sort_bamfile(base_name, samtools='samtools', verbose=True):
+    """sort and index [base_name].unsorted.bam into [base_name].bam, such as
+    one written by makegff while counting a stream"""
+    if not isfile(base_name + ".unsorted.bam"):
+        raise IOError("%s.unsorted.bam is not a file" % base_name)
+    if verbose:
+        print("starting processing on %s.unsorted.bam" % base_name)
+    _run_commands(_sort_commands(base_name, samtools), verbose)
+
+
 def main():
     from argparse import ArgumentParser
     try: